@@ -0,0 +1,655 @@
+import filecmp
+import fire
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+from tree_sitter import Node, Parser
+from library.repo_java_parser import RepoJavaParser
+from library.jsonl_utils import write_records
+from library.qa_dedup import NearDuplicateFilter, shingle_hashes
+from library.action_trace import ActionDocument, ActionTraces, fetch_action_traces
+from library.fake_elasticsearch import FakeElasticsearch
+from tools import merge_library_and_example_qa_result
+from library.java_parser import LANGUAGE, JAVA_LANG_CLASSES, JAVA_PRIMITIVE_TYPES, FIELD_DECLARATION_KIND_ID, JavaParser, JavaParseResult, \
+    ClassParseResult, FieldParseResult, collect_identifiers
+
+
+class RecursiveJavaParser(JavaParser):
+    """JavaParser with the recursive tree walker used before the TreeCursor one, kept as the benchmark baseline."""
+
+    def _traverse_tree(self, node: Node, rst: JavaParseResult, current_class: ClassParseResult = None):
+        if node.type == "identifier":
+            identifier = node.text.decode('utf-8')
+            if identifier[0].isupper() \
+                    and identifier not in JAVA_LANG_CLASSES \
+                    and identifier not in JAVA_PRIMITIVE_TYPES \
+                    and identifier not in rst.implicit_imports \
+                    and identifier not in [i.class_name for i in rst.imports]:
+                rst.implicit_imports.append(identifier)
+
+        elif node.type == "type_identifier":
+            type_identifier = node.text.decode('utf-8')
+            if type_identifier[0].isupper() \
+                    and type_identifier not in JAVA_LANG_CLASSES \
+                    and type_identifier not in JAVA_PRIMITIVE_TYPES \
+                    and type_identifier not in rst.implicit_imports \
+                    and type_identifier not in [i.class_name for i in rst.imports]:
+                rst.implicit_imports.append(type_identifier)
+
+        elif node.type == "package_declaration":
+            package_name_node = node.named_children[0]
+            if package_name_node:
+                rst.package = package_name_node.text.decode('utf-8')
+
+        elif node.type == "import_declaration":
+            import_text = node.text.decode('utf-8')
+            rst.imports.append(self._build_import_import_result(import_text))
+
+        elif (node.type == "class_declaration"
+                or node.type == "interface_declaration"
+                or node.type == "enum_declaration"
+                or node.type == "record_declaration"
+                or node.type == "annotation_type_declaration"):
+            new_class = self._build_class_parse_result(node)
+            rst.classes.append(new_class)
+            if not current_class:
+                rst.root = new_class.name
+            for child in node.children:
+                self._traverse_tree(child, rst, current_class=new_class)
+            return
+
+        elif node.type == "field_declaration":
+            if current_class:
+                current_class.fields.extend(self._build_field_parse_results(node))
+
+        elif node.type == "method_declaration":
+            if current_class:
+                method_result = self._build_method_parse_result(node)
+                # the first declaration of a name wins, as in JavaParser._traverse_tree
+                if method_result.name not in current_class.methods:
+                    body_node = node.child_by_field_name('body')
+                    if body_node:
+                        method_result.body_references = collect_identifiers(body_node)
+                    current_class.methods[method_result.name] = method_result
+
+        for child in node.children:
+            self._traverse_tree(child, rst, current_class)
+
+
+class JavaFieldParser:
+    """Parser of a single field declaration, reparsing its text, used before the fields were built from the file tree, kept as the benchmark baseline."""
+
+    def __init__(self, content: str = None):
+        self.result = None
+        self.parser = Parser(LANGUAGE)
+        if content is not None:
+            self.parse(content)
+    
+    def parse(self, content: str):
+        if self.result is not None: return self.result
+        
+        self.result = FieldParseResult()
+        
+        tree = self.parser.parse(content.encode())
+        node = tree.root_node.children[0]
+        if node.children[0].type == "modifiers":
+            self.result.modifiers = node.children[0].text.decode('utf-8')
+        self.result.type = node.child_by_field_name("type").text.decode('utf-8')
+        self.result.declarator = node.child_by_field_name("declarator").text.decode('utf-8')
+        
+    def is_inject(self):
+        return "@Inject" in self.result.modifiers
+
+
+class RecursiveActionTraces(ActionTraces):
+    """ActionTraces with the walk and tree rendering that rebuilt the children map on every call, kept as the benchmark baseline."""
+
+    def get_root_doc(self) -> Optional[ActionDocument]:
+        for doc in self.docs:
+            if doc.ref_ids is None or doc.ref_ids == []:
+                return doc
+        return None
+
+    def walk(self, level: Optional[int] = None):
+        if not self.docs:
+            return
+
+        root_doc = self.get_root_doc()
+        if not root_doc:
+            return
+
+        # Filter out docs with no ID to prevent errors and build the children map
+        docs_with_id = [doc for doc in self.docs if doc.id is not None]
+        children_map: Dict[str, List[ActionDocument]] = {doc.id: [] for doc in docs_with_id}
+        for doc in docs_with_id:
+            for parent_id in doc.ref_ids:
+                if parent_id in children_map:
+                    children_map[parent_id].append(doc)
+
+        # Sort children by timestamp for deterministic, chronological traversal
+        for parent_id in children_map:
+            # Handle cases where timestamp might be None
+            children_map[parent_id].sort(key=lambda d: d.timestamp or datetime.min)
+
+        # Use a set to track nodes in the current recursion path for cycle detection
+        def dfs(node: ActionDocument, current_level: int, recursion_stack: set):
+            # Cycle detection: if node.id is already in the current path, we have a cycle.
+            if node.id is not None and node.id in recursion_stack:
+                return
+
+            yield node
+
+            # Stop traversal if the specified level is reached
+            if level is not None and current_level >= level:
+                return
+
+            if node.id is not None:
+                recursion_stack.add(node.id)
+
+            for child in children_map.get(node.id, []):
+                yield from dfs(child, current_level + 1, recursion_stack)
+
+            if node.id is not None:
+                recursion_stack.remove(node.id)
+
+        # Start the traversal from the root at level 0
+        yield from dfs(root_doc, 0, set())
+
+    def __repr__(self) -> str:
+        if not self.docs:
+            return f"ActionTraces(action='{self.action}', status='No documents found')"
+
+        root_doc = self.get_root_doc()
+        if not root_doc:
+            return f"ActionTraces(action='{self.action}', status='No root document found')"
+
+        # Filter out docs with no ID to prevent errors and build the children map
+        docs_with_id = [doc for doc in self.docs if doc.id is not None]
+        children_map: Dict[str, List[ActionDocument]] = {doc.id: [] for doc in docs_with_id}
+        for doc in docs_with_id:
+            for parent_id in doc.ref_ids:
+                if parent_id in children_map:
+                    children_map[parent_id].append(doc)
+
+        # Sort children by timestamp for deterministic, chronological traversal
+        for parent_id in children_map:
+            children_map[parent_id].sort(key=lambda d: d.timestamp or datetime.min)
+
+        output_lines = []
+
+        def build_tree_string(node: ActionDocument, level: int = 0):
+            prefix = "    " * level
+            if level > 0:
+                prefix = "    " * (level - 1) + "└── "
+
+            context_parts = []
+            controller = node.get_context_controller()
+            if controller.controller:
+                context_parts.append(f"controller: {controller.controller}")
+
+            job_class = node.get_context_job_class()
+            if job_class.job_class:
+                context_parts.append(f"job_class: {job_class.job_class}")
+
+            handler = node.get_context_handler()
+            if handler.handler:
+                context_parts.append(f"handler: {handler.handler}")
+
+            context_str = ", ".join(context_parts)
+
+            output_lines.append(f"{prefix}app: {node.app}, action: {node.action}, {context_str}")
+
+            children = children_map.get(node.id, [])
+            for child in children:
+                build_tree_string(child, level + 1)
+
+        output_lines.append(f"--- Call Chain Starting from action: {self.action} ---")
+        build_tree_string(root_doc)
+
+        return "\n".join(output_lines)
+
+
+def _to_dict(o):
+    if isinstance(o, list):
+        return [_to_dict(i) for i in o]
+    if isinstance(o, dict):
+        return {k: _to_dict(v) for k, v in o.items()}
+    if hasattr(o, "to_dict"):
+        return {k: _to_dict(v) for k, v in o.to_dict().items()}
+    return o
+
+
+def _parse_trees(repo_path: str) -> list:
+    parser = Parser(LANGUAGE)
+    trees = []
+    for java_file in Path(repo_path).rglob("*.java"):
+        with open(java_file, "rb") as f:
+            trees.append((str(java_file), parser.parse(f.read())))
+    return trees
+
+
+def walker(repo_path: str, rounds: int = 3) -> None:
+    """
+    Compare the recursive and the TreeCursor tree walkers of JavaParser on every .java file of a repository.
+    Files are parsed once up front, only the walk over the tree is timed, the best of `rounds` runs is reported.
+
+    :param repo_path: Path to a repository with Java sources, e.g. a core-ng checkout.
+    :param rounds: Number of timed runs per walker.
+    """
+    trees = _parse_trees(repo_path)
+    print(f"Walking {len(trees)} Java files, recursion limit {sys.getrecursionlimit()}, best of {rounds} rounds")
+
+    timings = {}
+    results = {}
+    for name, parser_class in (("recursive", RecursiveJavaParser), ("cursor", JavaParser)):
+        java_parser = parser_class(parser=Parser(LANGUAGE))
+        for _ in range(rounds):
+            walked = {}
+            failed = 0
+            start = time.perf_counter()
+            for path, tree in trees:
+                rst = JavaParseResult()
+                rst.path = path
+                try:
+                    java_parser._traverse_tree(tree.root_node, rst)
+                    walked[path] = rst
+                except RecursionError:
+                    failed += 1
+            elapsed = time.perf_counter() - start
+            timings[name] = min(timings.get(name, elapsed), elapsed)
+        results[name] = walked
+        print(f"  - {name}: {timings[name]:.3f}s, {failed} files hit the recursion limit")
+
+    common = results["recursive"].keys() & results["cursor"].keys()
+    identical = all(_to_dict(results["recursive"][p]) == _to_dict(results["cursor"][p]) for p in common)
+    print(f"Speedup: {timings['recursive'] / timings['cursor']:.2f}x, identical results on {len(common)} files: {identical}")
+
+
+_INCREMENTAL_SOURCES = {
+    "app/a/Foo.java": "package app.a;\n\nimport app.c.Newcomer;\nimport app.b.Bar;\n\npublic class Foo {\n    Bar bar;\n    Newcomer newcomer;\n}\n",
+    "app/a/Baz.java": "package app.a;\n\npublic class Baz {\n    Foo foo;\n    Helper helper;\n}\n",
+    "app/b/Bar.java": "package app.b;\n\nimport java.util.List;\n\npublic class Bar {\n    List<String> names;\n}\n",
+}
+# each step writes (or deletes, for None) files, then the incremental update is compared against a full parse
+_INCREMENTAL_STEPS = [
+    ("add a new package", {"app/c/Newcomer.java": "package app.c;\n\npublic class Newcomer {\n}\n"}),
+    ("add a class to a package", {"app/a/Helper.java": "package app.a;\n\npublic class Helper {\n}\n"}),
+    ("change a file", {"app/b/Bar.java": "package app.b;\n\nimport app.a.Foo;\n\npublic class Bar {\n    Foo foo;\n}\n"}),
+    ("delete a package", {"app/c/Newcomer.java": None}),
+]
+
+
+def incremental() -> None:
+    """
+    Check that the incremental update of RepoJavaParser gives the same results and indexes as a full parse,
+    on a small generated repository changed step by step: a new package, a new class, a changed file and a deleted package.
+    """
+    def snapshot(repo_parser: RepoJavaParser) -> tuple:
+        return ({path: _to_dict(result) for path, result in repo_parser.result.items()}, repo_parser.class_index,
+                repo_parser.import_references, repo_parser.implicit_import_references)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        repo_path = Path(work_dir) / "repo"
+        ast_path = str(Path(work_dir) / "ast.json")
+
+        def write(files: Dict[str, Optional[str]]) -> None:
+            for name, source in files.items():
+                path = repo_path / name
+                if source is None:
+                    path.unlink()
+                    continue
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(source, encoding="utf-8")
+
+        write(_INCREMENTAL_SOURCES)
+        RepoJavaParser(str(repo_path), reparse=True, output_path=ast_path)
+        all_identical = True
+        for name, files in _INCREMENTAL_STEPS:
+            # apart in time so the mtime of rewritten files changes
+            time.sleep(0.01)
+            write(files)
+            updated = snapshot(RepoJavaParser(str(repo_path), output_path=ast_path, incremental=True))
+            parsed = snapshot(RepoJavaParser(str(repo_path), reparse=True, output_path=str(Path(work_dir) / "full.json")))
+            identical = updated == parsed
+            all_identical &= identical
+            print(f"  - {name}: identical results and indexes: {identical}")
+        print(f"Incremental update identical to a full parse on {len(_INCREMENTAL_STEPS)} steps: {all_identical}")
+
+
+def engines(repo_path: str, rounds: int = 3) -> None:
+    """
+    Compare the "cursor" and "query" extraction engines of JavaParser on every .java file of a repository.
+    Files are parsed once up front, only the extraction is timed, the best of `rounds` runs is reported.
+
+    :param repo_path: Path to a repository with Java sources, e.g. a core-ng checkout.
+    :param rounds: Number of timed runs per engine.
+    """
+    trees = _parse_trees(repo_path)
+    print(f"Extracting {len(trees)} Java files, best of {rounds} rounds")
+
+    timings = {}
+    results = {}
+    for engine in ("cursor", "query"):
+        java_parser = JavaParser(parser=Parser(LANGUAGE), engine=engine)
+        extract = java_parser._traverse_query if engine == "query" else java_parser._traverse_tree
+        for _ in range(rounds):
+            extracted = {}
+            start = time.perf_counter()
+            for path, tree in trees:
+                rst = JavaParseResult()
+                rst.path = path
+                extract(tree.root_node, rst)
+                extracted[path] = rst
+            elapsed = time.perf_counter() - start
+            timings[engine] = min(timings.get(engine, elapsed), elapsed)
+        results[engine] = extracted
+        print(f"  - {engine}: {timings[engine]:.3f}s")
+
+    different = [p for p in results["cursor"] if _to_dict(results["cursor"][p]) != _to_dict(results["query"][p])]
+    print(f"Speedup: {timings['cursor'] / timings['query']:.2f}x, identical results: {not different}")
+    for path in different[:10]:
+        print(f"  - different result: {path}")
+
+
+def _field_nodes(node: Node) -> list[Node]:
+    nodes = []
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current.kind_id == FIELD_DECLARATION_KIND_ID:
+            nodes.append(current)
+        stack.extend(reversed(current.children))
+    return nodes
+
+
+def fields(repo_path: str) -> None:
+    """
+    Compare building FieldParseResult with JavaFieldParser, which reparses the text of every field declaration,
+    against building it from the field node of the already parsed tree, and check both give the same fields.
+
+    :param repo_path: Path to a repository with Java sources, e.g. a core-ng checkout.
+    """
+    trees = _parse_trees(repo_path)
+    java_parser = JavaParser(parser=Parser(LANGUAGE))
+
+    reparse_times = []
+    node_times = []
+    field_count = 0
+    multi_declarator_count = 0
+    mismatches = []
+    for path, tree in trees:
+        nodes = _field_nodes(tree.root_node)
+        if not nodes:
+            continue
+
+        start = time.perf_counter()
+        reparsed = [JavaFieldParser(node.text.decode('utf-8').strip()).result for node in nodes]
+        reparse_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        built = [java_parser._build_field_parse_results(node) for node in nodes]
+        node_times.append(time.perf_counter() - start)
+
+        for node, old, new in zip(nodes, reparsed, built):
+            field_count += 1
+            declarators = node.children_by_field_name("declarator")
+            if len(declarators) > 1:
+                multi_declarator_count += 1
+            # the reparse path only kept the first declarator
+            if _to_dict(old) != _to_dict(new[0]) or len(new) != len(declarators):
+                mismatches.append(f"{path}:{node.start_point[0] + 1}")
+
+    files = len(reparse_times)
+    print(f"{field_count} field declarations in {files} files, {multi_declarator_count} with several declarators")
+    for name, times in (("reparse text", reparse_times), ("from node", node_times)):
+        per_file = sorted(times)
+        print(f"  - {name}: total {sum(times):.3f}s, per file mean {sum(times) / files * 1000:.3f}ms, "
+              f"median {per_file[files // 2] * 1000:.3f}ms, max {per_file[-1] * 1000:.3f}ms")
+    print(f"Speedup: {sum(reparse_times) / sum(node_times):.2f}x, identical fields: {not mismatches}")
+    for mismatch in mismatches[:10]:
+        print(f"  - different field: {mismatch}")
+
+
+def memory(repo_path: str, output_path: str = None) -> None:
+    """
+    Measure the memory held by a fully loaded RepoJavaParser, the AST cache is parsed first if it does not exist.
+
+    :param repo_path: Path to a repository with Java sources, e.g. a core-ng checkout.
+    :param output_path: Path of the AST cache file, defaults to ast.json in the repository.
+    """
+    RepoJavaParser(repo_path, output_path=output_path)
+    gc.collect()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    parser = RepoJavaParser(repo_path, output_path=output_path)
+    for path in parser.result:
+        _ = parser.result[path]  # the binary cache loads lazily
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"Loaded {len(parser.result)} files in {elapsed:.3f}s")
+    print(f"  - retained: {current / 1024 / 1024:.1f}MB ({current / len(parser.result) / 1024:.1f}KB per file), peak: {peak / 1024 / 1024:.1f}MB")
+
+
+def _merge_in_memory(library_qa_path: str, example_qa_path: str, output_qa_path: str) -> None:
+    """merge_library_and_example_qa_result before streaming, kept as the benchmark baseline."""
+    with open(library_qa_path, 'r', encoding='utf-8') as lib_file:
+        lib_qa = json.load(lib_file)
+
+    with open(example_qa_path, 'r', encoding='utf-8') as ex_file:
+        exm_qa = json.load(ex_file)
+
+    merged_qa = lib_qa + exm_qa
+
+    with open(output_qa_path, 'w', encoding='utf-8') as out_file:
+        for qa in merged_qa:
+            rst = {"prompt": qa['query'], "completion": qa['response']}
+            out_file.write(json.dumps(rst, ensure_ascii=False) + '\n')
+
+
+def _synthetic_qa(count: int, seed: int):
+    rnd = random.Random(seed)
+    words = ["action", "module", "http", "handler", "bean", "inject", "async", "task", "cache", "redis", "kafka", "message", "mongo", "db", "query", "log"]
+    for i in range(count):
+        yield {"query": f"Q{i}: " + " ".join(rnd.choices(words, k=20)) + "?",
+               "response": " ".join(rnd.choices(words, k=120)) + ".",
+               "filepath": f"/repo/src/main/java/core/framework/File{i % 5000}.java"}
+
+
+def merge(lines: int = 1_000_000, work_dir: str = None) -> None:
+    """
+    Compare the in-memory and the streaming merge of library and example Q&A on synthetic data,
+    library Q&A as a JSON array of 80% of `lines` records, example Q&A as JSONL of the rest.
+    Time and peak traced memory of each merge is reported, and the outputs are compared.
+
+    :param lines: Number of Q&A records of the inputs.
+    :param work_dir: Directory of the synthetic files, a temporary directory by default.
+    """
+    work_dir = work_dir or tempfile.mkdtemp(prefix="merge-benchmark-")
+    library_path = os.path.join(work_dir, "library.json")
+    example_path = os.path.join(work_dir, "example.jsonl")
+    example_array_path = os.path.join(work_dir, "example.json")
+    library_count = lines * 8 // 10
+
+    with open(library_path, 'w', encoding='utf-8') as f:
+        json.dump(list(_synthetic_qa(library_count, 1)), f, ensure_ascii=False, indent=2)
+    write_records(example_path, _synthetic_qa(lines - library_count, 2))
+    # the in-memory merge only reads JSON arrays
+    with open(example_array_path, 'w', encoding='utf-8') as f:
+        json.dump(list(_synthetic_qa(lines - library_count, 2)), f, ensure_ascii=False)
+    gc.collect()
+    print(f"Merging {lines:,} records, {os.path.getsize(library_path) / 1024 / 1024:.0f}MB JSON array + {os.path.getsize(example_path) / 1024 / 1024:.0f}MB JSONL, in {work_dir}")
+
+    outputs = {}
+    for name, run, example in (("in memory", _merge_in_memory, example_array_path), ("streaming", merge_library_and_example_qa_result, example_path)):
+        output_path = os.path.join(work_dir, f"train-{name.replace(' ', '-')}.jsonl")
+        tracemalloc.start()
+        start = time.perf_counter()
+        run(library_path, example, output_path)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc.collect()
+        outputs[name] = output_path
+        print(f"  - {name}: {elapsed:.1f}s, peak traced memory {peak / 1024 / 1024:.1f}MB")
+
+    print(f"Identical output: {filecmp.cmp(outputs['in memory'], outputs['streaming'], shallow=False)}")
+
+
+def dedup(lines: int = 1_000_000, duplicate_ratio: float = 0.1, near_miss_ratio: float = 0.1, threshold: float = 0.8) -> None:
+    """
+    Measure the throughput, recall and precision of NearDuplicateFilter on synthetic prompts.
+    `duplicate_ratio` of them are copies of an earlier prompt with one word appended (shingle Jaccard about 0.97),
+    they should be dropped. `near_miss_ratio` of them are copies with one inner word replaced and one word appended
+    (shingle Jaccard about 0.78, below the 0.8 threshold), they should be kept.
+
+    :param lines: Number of prompts.
+    :param duplicate_ratio: Fraction of the prompts that are near duplicates.
+    :param near_miss_ratio: Fraction of the prompts that are similar, but below the threshold.
+    :param threshold: Similarity threshold of the filter.
+    """
+    rnd = random.Random(0)
+    vocabulary = [f"word{i}" for i in range(20000)]
+    originals = []
+    injected = {"duplicate": 0, "near miss": 0, "original": 0}
+    dropped = {"duplicate": 0, "near miss": 0, "original": 0}
+    near_miss_similarity = 0.0
+    dedup_filter = NearDuplicateFilter(threshold=threshold)
+    start = time.perf_counter()
+    for _ in range(lines):
+        draw = rnd.random()
+        if originals and draw < duplicate_ratio:
+            kind = "duplicate"
+            text = " ".join(rnd.choice(originals) + [rnd.choice(vocabulary)])
+        elif originals and draw < duplicate_ratio + near_miss_ratio:
+            kind = "near miss"
+            source = rnd.choice(originals)
+            words = list(source)
+            words[rnd.randrange(10, 20)] = rnd.choice(vocabulary)
+            text = " ".join(words + [rnd.choice(vocabulary)])
+            if injected[kind] < 1000:
+                original, similar = shingle_hashes(" ".join(source)), shingle_hashes(text)
+                near_miss_similarity += len(original & similar) / len(original | similar)
+        else:
+            kind = "original"
+            words = rnd.choices(vocabulary, k=30)
+            text = " ".join(words)
+            if len(originals) < 100_000:
+                originals.append(words)
+        injected[kind] += 1
+        dropped[kind] += dedup_filter.is_duplicate(text)
+    elapsed = time.perf_counter() - start
+    print(f"{dedup_filter}")
+    print(f"  - {lines / elapsed:,.0f} prompts/s, {elapsed:.1f}s total, {len(dedup_filter.shingles) * 8 / 1024 / 1024:.1f}MB of shingles")
+    print(f"  - recall of injected near duplicates: {dropped['duplicate'] / max(injected['duplicate'], 1):.3f}")
+    print(f"  - precision of the dropped prompts: {dropped['duplicate'] / max(sum(dropped.values()), 1):.3f}, "
+          f"{dropped['near miss']} of {injected['near miss']} near misses dropped")
+    print(f"  - near misses are copies with one word replaced and one appended, mean similarity of the sample: "
+          f"{near_miss_similarity / max(min(injected['near miss'], 1000), 1):.3f}")
+
+
+def _synthetic_action_docs(actions: int, fanout: int, seed: int) -> list[dict]:
+    rnd = random.Random(seed)
+    docs = []
+    for a in range(actions):
+        for day in range(1, 4):
+            root_id = f"{a}-{day}"
+            correlation_id = [f"correlation-{a}-{day}"]
+            docs.append({"@timestamp": f"2025-01-0{day}T00:00:00Z", "id": root_id, "app": "website", "action": f"api:get:/action{a}",
+                         "correlation_id": correlation_id, "context": {"controller": [f"app.website.Action{a}WebServiceImpl.get"]}})
+            for i in range(fanout):
+                docs.append({"@timestamp": f"2025-01-0{day}T00:00:{i % 60:02d}Z", "id": f"{root_id}-{i}", "app": f"service{rnd.randrange(fanout)}",
+                             "action": f"topic:event{rnd.randrange(fanout)}", "ref_id": [root_id], "correlation_id": correlation_id,
+                             "context": {"handler": [f"app.service.Event{i}Handler"]}})
+    return docs
+
+
+def traces(actions: int = 100, fanout: int = 20, latency_ms: float = 5) -> None:
+    """
+    Compare fetching the traces of many actions one by one and with fetch_action_traces, against FakeElasticsearch
+    simulating `latency_ms` of network time per request. The round trips and time of each are reported, and the traces compared.
+
+    :param actions: Number of actions traced.
+    :param fanout: Number of documents correlated to each root document.
+    :param latency_ms: Simulated latency of each request.
+    """
+    docs = _synthetic_action_docs(actions, fanout, 0)
+    names = [f"api:get:/action{a}" for a in range(actions)]
+    results = {}
+    for name, fetch in (("one by one", lambda es: {action: ActionTraces(action, es=es) for action in names}),
+                        ("msearch", lambda es: fetch_action_traces(names, es=es))):
+        es = FakeElasticsearch(docs, latency=latency_ms / 1000)
+        start = time.perf_counter()
+        results[name] = fetch(es)
+        elapsed = time.perf_counter() - start
+        print(f"  - {name}: {es.requests} requests, {elapsed:.2f}s")
+
+    print(f"Identical traces: {all(str(results['one by one'][a]) == str(results['msearch'][a]) for a in names)}")
+
+
+def _synthetic_trace_docs(count: int, children: int) -> list[ActionDocument]:
+    # a tree of count docs with up to `children` children each, children 1 makes a chain of depth count
+    docs = []
+    for i in range(count):
+        parent = (i - 1) // children
+        docs.append(ActionDocument({"@timestamp": f"2025-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}Z", "id": f"doc{i}", "app": f"app{i % 7}",
+                                    "action": f"topic:event{i}", "ref_id": [f"doc{parent}"] if i else [], "correlation_id": ["correlation"],
+                                    "context": {"handler": [f"app.service.Event{i}Handler"]}}))
+    return docs
+
+
+def trace_walk(docs: int = 2000, children: int = 3, rounds: int = 20) -> None:
+    """
+    Compare the recursive walk and tree rendering of ActionTraces rebuilding the children map on every call with the
+    iterative one over the cached map, on a synthetic trace, as action2qa does: get_root_doc, walk and str per round.
+    A chain of `docs` documents is walked as well, deeper than the recursion limit.
+
+    :param docs: Number of documents of the trace.
+    :param children: Number of children of each document.
+    :param rounds: Number of walks of each trace.
+    """
+    trace_docs = _synthetic_trace_docs(docs, children)
+    results = {}
+    for name, traces_class in (("recursive", RecursiveActionTraces), ("iterative", ActionTraces)):
+        traces = traces_class("topic:event0", docs=trace_docs)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            traces.get_root_doc()
+            walked = [doc.id for doc in traces.walk(3)] + [doc.id for doc in traces.walk()]
+            rendered = str(traces)
+        elapsed = time.perf_counter() - start
+        results[name] = (walked, rendered)
+        print(f"  - {name}: {elapsed / rounds * 1000:.1f}ms per round")
+    print(f"Identical walks and trees: {results['recursive'] == results['iterative']}")
+
+    chain_docs = _synthetic_trace_docs(max(docs, sys.getrecursionlimit() + 1), 1)
+    for name, traces_class in (("recursive", RecursiveActionTraces), ("iterative", ActionTraces)):
+        try:
+            print(f"  - {name} walk of a chain of {len(chain_docs)} docs: {sum(1 for _ in traces_class('topic:event0', docs=chain_docs).walk())} docs")
+        except RecursionError:
+            print(f"  - {name} walk of a chain of {len(chain_docs)} docs: RecursionError")
+
+
+if __name__ == "__main__":
+    fire.Fire({
+        "walker": walker,
+        "engines": engines,
+        "incremental": incremental,
+        "fields": fields,
+        "memory": memory,
+        "merge": merge,
+        "dedup": dedup,
+        "traces": traces,
+        "trace_walk": trace_walk
+    })
@@ -5,10 +5,15 @@ import litellm
 import json
 import os
 import textwrap
+import time
+from functools import lru_cache
 from pathlib import Path
-from token_cost_counter import count_cost
-from library.action_trace import ActionTraces, RecentActions
+from token_cost_counter import pack_by_token_budget, record_usage, TokenBudgetStats, UsageLedger
+from library.action_trace import ActionTraces, RecentActions, fetch_action_traces
 from library.repo_java_parser import RepoJavaParser
+from library.trace_store import TraceSnapshotStore
+from library.llm_cache import LLMResponseCache, cached_completion, json_content, is_json_response
+from library.jsonl_utils import is_json_array, read_records, append_records, load_processed_keys
 from repo_action_java_parser import fetch_action_context
 from typing import Optional
 
@@ -61,14 +66,19 @@ You MUST provide the output in a single, valid JSON block. The root element must
 
 
 LITELLM_MODEL = "azure/gpt-4o"
+SOURCE_CODES_TOKEN_BUDGET = 24000
 
-def generate_qa_pairs(action_trace: str, relevant_source_codes: str) -> Optional[str]:
+def generate_qa_pairs(action_trace: str, relevant_source_codes: str, cache: Optional[LLMResponseCache] = None, ledger: Optional[UsageLedger] = None,
+                      action: str = None) -> Optional[str]:
     """
     Generates Q&A pairs for a target file using an LLM.
 
     Args:
         action_trace: A string containing the action trace for the action.
         relevant_source_codes: A string containing the source code of dependency files.
+        cache: The LLM response cache, None always calls the LLM.
+        ledger: Records the usage of the LLM request.
+        action: The action the Q&A is generated for, the label of the request in the ledger.
 
     Returns:
         A string containing a JSON array of Q&A pairs, or None if an error occurs.
@@ -80,29 +90,19 @@ def generate_qa_pairs(action_trace: str, relevant_source_codes: str) -> Optional
     )
 
     try:
-        response = litellm.completion(
+        start = time.perf_counter()
+        response = cached_completion(
+            cache,
             model=LITELLM_MODEL,
             messages=[{"role": "user", "content": prompt}],
+            validate=is_json_response,
             temperature=0.1,  # Lower temperature for more factual, less creative output
         )
 
-        # Extract the text content from the response
-        content = response.choices[0].message.content
-
-        # Clean the response: LLMs sometimes wrap JSON in markdown fences (```json ... ```)
-        if content.strip().startswith("```json"):
-            content = content.strip()[7:-3].strip()
-        elif content.strip().startswith("```"):
-            content = content.strip()[3:-3].strip()
-
-        usage = response.get("usage")
-        completion_tokens = usage.get("completion_tokens", 0)
-        completion_cost = count_cost(completion_tokens, model=LITELLM_MODEL, token_type="input_cost_per_token")
-        prompt_tokens = usage.get("prompt_tokens", 0)
-        prompt_cost = count_cost(completion_tokens, model=LITELLM_MODEL, token_type="output_cost_per_token")
-        total_tokens = usage.get("total_tokens", 0)
-        total_cost = completion_cost + prompt_cost
-        print(f"  - Usage: {completion_tokens} completion tokens - cost: {completion_cost}, {prompt_tokens} prompt tokens - cost: {prompt_cost}, {total_tokens} total tokens - cost: {total_cost}")
+        # Extract the text content from the response, without markdown fences
+        content = json_content(response)
+
+        record_usage(response, LITELLM_MODEL, time.perf_counter() - start, ledger, label=action)
         # Validate that the content is valid JSON
         json.loads(content)
         return content
@@ -116,50 +116,87 @@ def generate_qa_pairs(action_trace: str, relevant_source_codes: str) -> Optional
         return None
 
 
-def build_relevant_source_codes(repo_parser: RepoJavaParser, action: str) -> str:
-    files = fetch_action_context(action, repo_parser, level=1)
-    rst = "Relevant files for action: " + action + "\n\n"
+@lru_cache(maxsize=2048)
+def read_source_file(file_path: str) -> str:
+    """
+    Reads a source file once per run, the same interfaces and DTOs show up in the traces of many actions.
+    """
+    return Path(file_path).read_text(encoding="utf-8")
+
+
+def build_relevant_source_codes(repo_parser: RepoJavaParser, action: str, traces: ActionTraces = None, token_budget: int = SOURCE_CODES_TOKEN_BUDGET,
+                                stats: Optional[TokenBudgetStats] = None) -> str:
+    """
+    Builds the source codes of the files of an action trace, packed in a token budget.
+
+    Files are deduplicated and ranked by their first appearance in the trace, the handler of the action first.
+    Every packed file is rendered with its class and method signatures, and upgraded to the whole file in
+    rank order while the budget allows, so low-priority dependencies are kept as signatures only.
+    """
+    files = list(dict.fromkeys(fetch_action_context(action, repo_parser, level=1, trace=traces)))
+    candidates = []
     for file_path in files:
-        rst += f"### {file_path}\n"
         try:
-            file_content = Path(file_path).read_text(encoding="utf-8")
-            rst += file_content + "\n\n"
+            file_content = read_source_file(file_path)
         except FileNotFoundError:
             print(f"!! ERROR: File {file_path} not found in the repository.")
             continue
-    return rst
+        renderings = [f"### {file_path}\n{file_content}\n\n"]
+        rst = repo_parser.result.get(file_path)
+        if rst is not None:
+            renderings.insert(0, f"### {file_path}\n{rst}\n\n")
+        candidates.append(renderings)
+    rst = "Relevant files for action: " + action + "\n\n"
+    return rst + "".join(pack_by_token_budget(candidates, token_budget, model=LITELLM_MODEL, stats=stats))
 
 
-def action2qa(repo_path: str, action: str, repo_parser: RepoJavaParser = None, rst_path: str = "example-repo-action-to-qa.jsonl") -> None:
+def action2qa(repo_path: str, action: str, repo_parser: RepoJavaParser = None, rst_path: str = "example-repo-action-to-qa.jsonl",
+              processed_actions: Optional[set[str]] = None, cache: Optional[LLMResponseCache] = None,
+              source_codes_token_budget: int = SOURCE_CODES_TOKEN_BUDGET, source_codes_stats: Optional[TokenBudgetStats] = None,
+              ledger: Optional[UsageLedger] = None, traces: Optional[ActionTraces] = None, trace_store: Optional[TraceSnapshotStore] = None) -> str:
+    """
+    Generates the Q&A pairs of one action and appends them to rst_path as JSON lines.
+
+    :param processed_actions: The actions already in rst_path, loaded from rst_path if not given.
+    :param cache: The LLM response cache, None always calls the LLM.
+    :param source_codes_token_budget: Maximum number of tokens of the relevant source codes.
+    :param source_codes_stats: Accumulates the tokens included in and dropped from the relevant source codes.
+    :param ledger: Records the usage of the LLM requests and the processed actions.
+    :param traces: The action traces if already fetched, e.g. by fetch_action_traces, fetched from Elasticsearch otherwise.
+    :param trace_store: The trace snapshot store the traces are loaded from before Elasticsearch, and saved to.
+    :return: "skipped" if the action is already in rst_path, "saved" if Q&A pairs were appended, otherwise "failed".
+    """
     if not repo_parser:
         repo_parser = RepoJavaParser(repo_path)
 
     output_path = Path(rst_path)
 
     # Check if the file has already been processed
-    if os.path.exists(output_path):
-        with open(output_path, 'r', encoding="utf-8") as f:
-            existing_data = json.load(f)
-        processed_actions = {entry.get("action") for entry in existing_data}
-        if action in processed_actions:
-            print(f"  - SKIPPED: {action} is already processed.")
-            return
-    else:
-        existing_data = []
+    if processed_actions is None:
+        processed_actions = load_processed_actions(output_path)
+    if action in processed_actions:
+        print(f"  - SKIPPED: {action} is already processed.")
+        return "skipped"
+    if ledger:
+        ledger.count_file()
 
     try:
-        # 1. get action traces
-        traces = ActionTraces(action)
+        # 1. get action traces, shared with the relevant source codes builder
+        if traces is None:
+            traces = ActionTraces(action, store=trace_store)
         action_trace = str(traces)
 
         # 2. Build the relevant_source_codes
         print("  - Building relevant_source_codes...")
-        relevant_source_codes = build_relevant_source_codes(repo_parser, action)
+        relevant_source_codes = build_relevant_source_codes(repo_parser, action, traces, source_codes_token_budget, source_codes_stats)
 
         # 3. Generate Q&A pairs
         qa_json_str = generate_qa_pairs(
             action_trace=action_trace,
-            relevant_source_codes=relevant_source_codes
+            relevant_source_codes=relevant_source_codes,
+            cache=cache,
+            ledger=ledger,
+            action=action
         )
 
         # 4. Save the result to a file
@@ -167,29 +204,60 @@ def action2qa(repo_path: str, action: str, repo_parser: RepoJavaParser = None, r
             new_data = json.loads(qa_json_str)
 
             # Add filepath field to each entry
+            app = traces.get_root_doc().app
             for entry in new_data:
                 entry["action"] = action
-                entry["app"] = traces.get_root_doc().app
-
-            # Append new Q&A pairs to the existing data
-            existing_data.extend(new_data)
+                entry["app"] = app
 
-            # Write the updated data back to the file
-            with open(output_path, 'w', encoding="utf-8") as f:
-                json.dump(existing_data, f, ensure_ascii=False, indent=2)
+            # Append new Q&A pairs to the file
+            append_records(output_path, new_data)
+            processed_actions.add(action)
             print(f"  - SUCCESS: Saved Q&A to {output_path.name}")
+            return "saved"
         else:
             print("  - FAILED: No Q&A data was generated.")
 
     except Exception as e:
         print(f"!! ERROR: An unexpected error occurred while processing {action}: {e}")
+    return "failed"
+
 
+def load_processed_actions(output_path: Path) -> set[str]:
+    if os.path.exists(output_path) and is_json_array(output_path):
+        raise ValueError(f"{output_path} is a JSON array, convert it to JSONL first: python tools.py to_jsonl {output_path}")
+    return load_processed_keys(output_path, lambda entry: entry.get("action"))
 
 
+def load_checkpoint(checkpoint_path: Path) -> dict[str, str]:
+    """
+    Reads the status of every action finished by previous runs, the last status of an action wins.
+    """
+    if not os.path.exists(checkpoint_path):
+        return {}
+    return {entry["action"]: entry["status"] for entry in read_records(checkpoint_path)}
+
 
-def repo2qa(repo_path: str, size: int = 100, rst_path ="example-repo-action-to-qa.jsonl") -> None:
+def repo2qa(repo_path: str, size: int = 100, rst_path ="example-repo-action-to-qa.jsonl", checkpoint_path: str = None, retry_failed: bool = True,
+            no_cache: bool = False, cache_path: str = "llm-cache.sqlite", source_codes_token_budget: int = SOURCE_CODES_TOKEN_BUDGET,
+            ledger_path: str = "usage-ledger.jsonl", trace_store_path: str = "trace-snapshots.sqlite", trace_ttl_hours: float = 168) -> None:
     """
-    Traverses a repository, finds all .java files, and generates Q&A pairs for each.
+    Generates Q&A pairs for the recent actions of a repository, the run can be stopped and resumed at any time.
+
+    Every finished action is appended to the checkpoint file with its status, a resumed run skips the actions
+    saved in the checkpoint and, unless retry_failed is set, the failed ones as well.
+
+    :param repo_path: The root path of the repository.
+    :param size: Number of recent actions to process.
+    :param rst_path: The path where the generated Q&A will be appended as JSON lines.
+    :param checkpoint_path: The path of the checkpoint file, defaults to rst_path + ".checkpoint".
+    :param retry_failed: Process again the actions that failed in previous runs, failures are mostly transient
+                         (LLM timeouts, Elasticsearch outages, empty traces), --noretry_failed skips them.
+    :param no_cache: Always call the LLM, without reading or writing the LLM response cache.
+    :param cache_path: The SQLite file of the LLM response cache, responses of identical prompts are reused from it.
+    :param source_codes_token_budget: Maximum number of tokens of the relevant source codes of each action.
+    :param ledger_path: JSONL file the usage of every LLM request and of the run is appended to, files are actions here.
+    :param trace_store_path: SQLite file of the action trace snapshots, traces are loaded from it before Elasticsearch, empty to disable.
+    :param trace_ttl_hours: Age after which a trace snapshot is fetched again, 0 keeps snapshots forever.
     """
     print(f"Starting Q&A generation for repository: {repo_path}")
     print("=" * 60)
@@ -197,19 +265,55 @@ def repo2qa(repo_path: str, size: int = 100, rst_path ="example-repo-action-to-q
     parser = RepoJavaParser(repo_path)
     actions = RecentActions(size, path="recent_actions.json")
 
-    print(f"Found {len(actions.actions)} actions to process.\n")
+    output_path = Path(rst_path)
+    checkpoint_path = Path(checkpoint_path or rst_path + ".checkpoint")
+    processed_actions = load_processed_actions(output_path)
+    checkpoint = load_checkpoint(checkpoint_path)
+    cache = None if no_cache else LLMResponseCache(cache_path)
+    trace_store = TraceSnapshotStore(trace_store_path, trace_ttl_hours) if trace_store_path else None
+    source_codes_stats = TokenBudgetStats()
+    ledger = UsageLedger(ledger_path, LITELLM_MODEL, command="example_repo_actions_to_qa", source_codes_token_budget=source_codes_token_budget)
+
+    print(f"Found {len(actions.actions)} actions to process, {len(checkpoint)} finished by previous runs.\n")
+
+    def is_finished(action: str) -> bool:
+        status = checkpoint.get(action)
+        return status == "saved" or (status == "failed" and not retry_failed)
+
+    # fetch the traces of all pending actions in two round trips, actions missing here are fetched one by one
+    pending_actions = [action.action for action in actions.actions if not is_finished(action.action) and action.action not in processed_actions]
+    try:
+        traces = fetch_action_traces(pending_actions, store=trace_store)
+    except Exception as e:
+        print(f"!! ERROR: Failed to fetch the traces of {len(pending_actions)} actions at once: {e}")
+        traces = {}
 
     for i, action in enumerate(actions.actions):
+        if is_finished(action.action):
+            print(f"[{i + 1}/{len(actions.actions)}] SKIPPED: {action.action} is {checkpoint[action.action]} in {checkpoint_path.name}")
+            continue
         print(f"[{i + 1}/{len(actions.actions)}] Processing: {action}")
         try:
-            action2qa(repo_path, action.action, parser, rst_path=rst_path)
+            status = action2qa(repo_path, action.action, parser, rst_path=rst_path, processed_actions=processed_actions, cache=cache,
+                               source_codes_token_budget=source_codes_token_budget, source_codes_stats=source_codes_stats, ledger=ledger,
+                               traces=traces.get(action.action), trace_store=trace_store)
         except Exception as e:
             print(f"  !! FATAL ERROR in action2qa for {action}: {e}")
+            status = "failed"
+        if status == "skipped":
+            status = "saved"
+        append_records(checkpoint_path, [{"action": action.action, "status": status}])
+        checkpoint[action.action] = status
         print("-" * 40)
 
     print("\n" + "=" * 60)
     print("Repository processing complete.")
-
+    print(f"Relevant source codes: {source_codes_stats}")
+    ledger.close()
+    if trace_store:
+        print(f"Trace snapshots: {trace_store}")
+    if cache:
+        print(f"LLM response cache: {cache.hits} hits, {cache.misses} misses")
 
 
 if __name__ == "__main__":
@@ -2,9 +2,70 @@
 
 import os
 import json
+import threading
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+from functools import cached_property
+from itertools import chain
+from typing import List, Dict, Any, Iterable, Iterator, Optional
 from elasticsearch import Elasticsearch
+from .trace_store import TraceSnapshotStore
+
+
+# options of the shared client, the transport keeps alive and pools the connections of each node
+ELASTIC_CLIENT_OPTIONS = {
+    "request_timeout": float(os.environ.get("ELASTIC_REQUEST_TIMEOUT", 30)),
+    "max_retries": int(os.environ.get("ELASTIC_MAX_RETRIES", 3)),
+    "retry_on_timeout": True,
+    "connections_per_node": 10,
+}
+
+# fields of the action documents transferred for traces, the stats and perf_stats maps and the other context keys are
+# never used by traces and can be large, ActionDocument reads them as empty
+ACTION_DOCUMENT_SOURCE = ["@timestamp", "id", "app", "host", "result", "ref_id", "correlation_id", "client", "action",
+                          "error_code", "error_message", "elapsed", "context.controller", "context.job_class", "context.handler"]
+# correlated documents fetched per request, a trace with more is paginated
+CORRELATION_PAGE_SIZE = 1000
+
+_clients: Dict[Optional[str], Any] = {}
+_clients_lock = threading.Lock()
+
+
+def configure_elasticsearch(elastic_url: Optional[str] = None, client: Any = None, **options) -> Any:
+    """
+    Sets the process-wide client of elastic_url (ELASTIC_URL by default), shared by ActionTraces and RecentActions.
+
+    Pass client to plug in another implementation, e.g. FakeElasticsearch in tests, or options overriding
+    ELASTIC_CLIENT_OPTIONS (request_timeout, max_retries, node_class for a custom transport, ...).
+    """
+    elastic_url = elastic_url or os.environ.get("ELASTIC_URL")
+    if client is None:
+        if not elastic_url:
+            raise ValueError("ELASTIC_URL environment variable is not set")
+        client = Elasticsearch(elastic_url, **{**ELASTIC_CLIENT_OPTIONS, **options})
+    with _clients_lock:
+        previous = _clients.get(elastic_url)
+        _clients[elastic_url] = client
+    if previous is not None and previous is not client and hasattr(previous, "close"):
+        previous.close()
+    return client
+
+
+def get_elasticsearch(elastic_url: Optional[str] = None) -> Any:
+    """
+    The process-wide client of elastic_url (ELASTIC_URL by default), created on first use and reused by every query.
+    """
+    elastic_url = elastic_url or os.environ.get("ELASTIC_URL")
+    client = _clients.get(elastic_url)
+    if client is not None:
+        return client
+    if not elastic_url:
+        raise ValueError("ELASTIC_URL environment variable is not set")
+    with _clients_lock:
+        client = _clients.get(elastic_url)
+        if client is None:
+            client = Elasticsearch(elastic_url, **ELASTIC_CLIENT_OPTIONS)
+            _clients[elastic_url] = client
+        return client
 
 
 class ActionDocumentContextHandler:
@@ -62,6 +123,8 @@ class ActionDocumentContextController:
 
 class ActionDocument:
     def __init__(self, source_doc: Dict[str, Any]):
+        # kept to save the document in trace snapshots
+        self.source = source_doc
         timestamp_str = source_doc.get("@timestamp")
         self.timestamp: Optional[datetime] = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00')) if timestamp_str else None
 
@@ -106,91 +169,211 @@ class ActionDocument:
         return f"ActionDocument(id={self.id}, action={self.action})"
 
 
+def _action_document_query(action: str) -> Dict[str, Any]:
+    return {
+        "query": {
+            "match": {
+                "action": action
+            }
+        },
+        "sort": [
+            {"@timestamp": {"order": "desc"}}
+        ],
+        "size": 1,
+        "_source": ACTION_DOCUMENT_SOURCE
+    }
+
+
+def _correlation_documents_query(correlation_id: List[str]) -> Dict[str, Any]:
+    return {
+        "query": {
+            "terms": {
+                "correlation_id": correlation_id
+            }
+        },
+        "sort": [
+            {"@timestamp": {"order": "asc"}}
+        ],
+        "size": CORRELATION_PAGE_SIZE,
+        "_source": ACTION_DOCUMENT_SOURCE
+    }
+
+
+def _iter_correlation_documents(es: Any, index: str, correlation_id: List[str], page_size: int = CORRELATION_PAGE_SIZE) -> Iterator[ActionDocument]:
+    """
+    Streams all documents of the correlation ids page by page, with search_after in a point in time so the
+    pages are consistent while new documents are indexed.
+    """
+    pit_id = es.open_point_in_time(index=index, keep_alive="1m")["id"]
+    try:
+        query = _correlation_documents_query(correlation_id)
+        # _shard_doc breaks the ties of documents with the same timestamp, so no document is skipped between pages
+        query["sort"] = query["sort"] + [{"_shard_doc": "asc"}]
+        query["size"] = page_size
+        while True:
+            query["pit"] = {"id": pit_id, "keep_alive": "1m"}
+            result = es.search(body=query)
+            pit_id = result.get("pit_id", pit_id)
+            hits = result["hits"]["hits"]
+            for hit in hits:
+                yield ActionDocument(hit["_source"])
+            if len(hits) < page_size:
+                return
+            query["search_after"] = hits[-1]["sort"]
+    finally:
+        es.close_point_in_time(id=pit_id)
+
+
+def _correlation_documents(es: Any, index: str, correlation_id: List[str], first_page: Optional[Dict[str, Any]]) -> Iterable[ActionDocument]:
+    # most traces fit in the first page of a plain search, the others are paginated from the start
+    if first_page is None:
+        return []
+    hits = first_page["hits"]["hits"]
+    if first_page["hits"]["total"]["value"] > len(hits):
+        return _iter_correlation_documents(es, index, correlation_id)
+    return [ActionDocument(hit["_source"]) for hit in hits]
+
+
+def _trace_docs(action: str, root_doc: Optional[ActionDocument], related_docs: Iterable[ActionDocument]) -> List[ActionDocument]:
+    if not root_doc:
+        print(f"No document found for action: {action}")
+        return []
+
+    if not root_doc.correlation_ids:
+        print(f"No correlation_id found in document for action: {action}")
+        return [root_doc]
+
+    all_docs = chain([root_doc], related_docs)
+    # remove duplicates based on app and action
+    seen = set()
+    unique_docs = []
+    for doc in all_docs:
+        identifier = (doc.app, doc.action)
+        if identifier not in seen and (doc.get_context_controller().controller
+                                       or doc.get_context_job_class().job_class
+                                       or doc.get_context_handler()):
+            seen.add(identifier)
+            unique_docs.append(doc)
+    return unique_docs
+
+
+def _msearch(es: Any, index: str, queries: List[Dict[str, Any]]) -> List[Optional[Dict[str, Any]]]:
+    searches = []
+    for query in queries:
+        searches.append({"index": index})
+        searches.append(query)
+    responses = es.msearch(searches=searches)["responses"]
+    results = []
+    for response in responses:
+        if "error" in response:
+            print(f"Search failed in msearch: {response['error']}")
+            results.append(None)
+        else:
+            results.append(response)
+    return results
+
+
+def _load_snapshot(store: Optional[TraceSnapshotStore], action: str) -> Optional[List[ActionDocument]]:
+    if store is None:
+        return None
+    sources = store.get(action)
+    return None if sources is None else [ActionDocument(source) for source in sources]
+
+
+def fetch_action_traces(actions: List[str], elastic_url: Optional[str] = None, index: str = "action-*", es: Any = None,
+                        store: Optional[TraceSnapshotStore] = None) -> Dict[str, "ActionTraces"]:
+    """
+    Fetches the traces of many actions in two round trips instead of two per action: one msearch for the latest
+    document of every action, then one msearch for the correlated documents of all of them.
+    The few traces with more correlated documents than one page are paginated on their own.
+    Actions with a snapshot in store are loaded from it, the fetched traces are saved to it.
+
+    :return: The ActionTraces of every action, by action.
+    """
+    all_actions = list(dict.fromkeys(actions))
+    traces: Dict[str, ActionTraces] = {}
+    for action in all_actions:
+        docs = _load_snapshot(store, action)
+        if docs is not None:
+            traces[action] = ActionTraces(action, elastic_url, index, es, docs=docs)
+    actions = [action for action in all_actions if action not in traces]
+    if not actions:
+        return traces
+    es = es if es is not None else get_elasticsearch(elastic_url)
+
+    # traces of failed searches are not saved as snapshots
+    failed_actions = set()
+    root_docs: Dict[str, Optional[ActionDocument]] = {}
+    for action, response in zip(actions, _msearch(es, index, [_action_document_query(action) for action in actions])):
+        if response is None:
+            failed_actions.add(action)
+        hits = response["hits"]["hits"] if response else []
+        root_docs[action] = ActionDocument(hits[0]["_source"]) if hits else None
+
+    related_docs: Dict[str, Iterable[ActionDocument]] = {}
+    correlated_actions = [action for action in actions if root_docs[action] and root_docs[action].correlation_ids]
+    if correlated_actions:
+        queries = [_correlation_documents_query(root_docs[action].correlation_ids) for action in correlated_actions]
+        for action, response in zip(correlated_actions, _msearch(es, index, queries)):
+            if response is None:
+                failed_actions.add(action)
+            related_docs[action] = _correlation_documents(es, index, root_docs[action].correlation_ids, response)
+
+    for action in actions:
+        docs = _trace_docs(action, root_docs[action], related_docs.get(action, []))
+        if store is not None and action not in failed_actions:
+            store.put(action, [doc.source for doc in docs])
+        traces[action] = ActionTraces(action, elastic_url, index, es, docs=docs)
+    return {action: traces[action] for action in all_actions}
+
+
 class ActionTraces:
-    def __init__(self, action: str, elastic_url: Optional[str] = None, index: str = "action-*"):
+    def __init__(self, action: str, elastic_url: Optional[str] = None, index: str = "action-*", es: Any = None,
+                 docs: Optional[List[ActionDocument]] = None, store: Optional[TraceSnapshotStore] = None):
         self.action = action
         self.elastic_url = elastic_url or os.environ.get("ELASTIC_URL")
         self.index = index
-        self.docs = self._fetch_all_docs()
+        self.es = es
+        # docs given are already fetched, e.g. by fetch_action_traces, otherwise loaded from the snapshot store if any
+        if docs is None:
+            docs = _load_snapshot(store, action)
+        if docs is None:
+            docs = self._fetch_all_docs()
+            if store is not None:
+                store.put(action, [doc.source for doc in docs])
+        self.docs = docs
 
     def _connect(self):
-        if not self.elastic_url:
-            raise ValueError("ELASTIC_URL environment variable is not set")
-        return Elasticsearch(self.elastic_url)
+        if self.es is None:
+            self.es = get_elasticsearch(self.elastic_url)
+        return self.es
 
     def _fetch_action_document(self) -> Optional[ActionDocument]:
         es = self._connect()
-        query = {
-            "query": {
-                "match": {
-                    "action": self.action
-                }
-            },
-            "sort": [
-                {"@timestamp": {"order": "desc"}}
-            ],
-            "size": 1
-        }
-        result = es.search(index=self.index, body=query)
+        result = es.search(index=self.index, body=_action_document_query(self.action))
         if result["hits"]["total"]["value"] > 0:
             return ActionDocument(result["hits"]["hits"][0]["_source"])
         return None
 
-    def _fetch_correlation_documents(self, correlation_id: List[str]) -> List[ActionDocument]:
+    def _fetch_correlation_documents(self, correlation_id: List[str]) -> Iterable[ActionDocument]:
         es = self._connect()
-        query = {
-            "query": {
-                "terms": {
-                    "correlation_id": correlation_id
-                }
-            },
-            "sort": [
-                {"@timestamp": {"order": "asc"}}
-            ],
-            "size": 1000
-        }
-        result = es.search(index=self.index, body=query)
-        return [ActionDocument(hit["_source"]) for hit in result["hits"]["hits"]]
+        result = es.search(index=self.index, body=_correlation_documents_query(correlation_id))
+        return _correlation_documents(es, self.index, correlation_id, result)
 
     def _fetch_all_docs(self) -> List[ActionDocument]:
         root_doc = self._fetch_action_document()
-        if not root_doc:
-            print(f"No document found for action: {self.action}")
-            return []
-
-        correlation_ids = root_doc.correlation_ids
-        if not correlation_ids:
-            print(f"No correlation_id found in document for action: {self.action}")
-            return [root_doc]
-
-        related_docs = self._fetch_correlation_documents(correlation_ids)
-        all_docs = [root_doc] + related_docs
-        # remove duplicates based on app and action
-        seen = set()
-        unique_docs = []
-        for doc in all_docs:
-            identifier = (doc.app, doc.action)
-            if identifier not in seen and (doc.get_context_controller().controller
-                                           or doc.get_context_job_class().job_class
-                                           or doc.get_context_handler()):
-                seen.add(identifier)
-                unique_docs.append(doc)
-        return unique_docs
+        related_docs = self._fetch_correlation_documents(root_doc.correlation_ids) if root_doc and root_doc.correlation_ids else []
+        return _trace_docs(self.action, root_doc, related_docs)
 
-    def get_root_doc(self) -> Optional[ActionDocument]:
+    @cached_property
+    def root_doc(self) -> Optional[ActionDocument]:
         for doc in self.docs:
             if doc.ref_ids is None or doc.ref_ids == []:
                 return doc
         return None
 
-    def walk(self, level: Optional[int] = None):
-        if not self.docs:
-            return
-
-        root_doc = self.get_root_doc()
-        if not root_doc:
-            return
-
+    @cached_property
+    def children_map(self) -> Dict[str, List[ActionDocument]]:
         # Filter out docs with no ID to prevent errors and build the children map
         docs_with_id = [doc for doc in self.docs if doc.id is not None]
         children_map: Dict[str, List[ActionDocument]] = {doc.id: [] for doc in docs_with_id}
@@ -203,54 +386,59 @@ class ActionTraces:
         for parent_id in children_map:
             # Handle cases where timestamp might be None
             children_map[parent_id].sort(key=lambda d: d.timestamp or datetime.min)
+        return children_map
 
-        # Use a set to track nodes in the current recursion path for cycle detection
-        def dfs(node: ActionDocument, current_level: int, recursion_stack: set):
-            # Cycle detection: if node.id is already in the current path, we have a cycle.
-            if node.id is not None and node.id in recursion_stack:
-                return
-
-            yield node
-
-            # Stop traversal if the specified level is reached
-            if level is not None and current_level >= level:
-                return
-
-            if node.id is not None:
-                recursion_stack.add(node.id)
-
-            for child in children_map.get(node.id, []):
-                yield from dfs(child, current_level + 1, recursion_stack)
-
-            if node.id is not None:
-                recursion_stack.remove(node.id)
+    def get_root_doc(self) -> Optional[ActionDocument]:
+        return self.root_doc
+
+    def _walk_levels(self, level: Optional[int] = None) -> Iterator[tuple[ActionDocument, int]]:
+        """
+        Depth first traversal from the root doc with an explicit stack, yields each doc with its level.
+        A doc already on the current path is skipped, so cycles end the branch.
+        """
+        root_doc = self.root_doc
+        if not root_doc:
+            return
+        children_map = self.children_map
 
-        # Start the traversal from the root at level 0
-        yield from dfs(root_doc, 0, set())
+        yield root_doc, 0
+        # Stop traversal if the specified level is reached
+        if level is not None and level <= 0:
+            return
+        path = {root_doc.id} if root_doc.id is not None else set()
+        stack = [(root_doc, 0, iter(children_map.get(root_doc.id, ())))]
+        while stack:
+            node, node_level, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                path.discard(node.id)
+                continue
+            # Cycle detection: if child.id is already in the current path, we have a cycle.
+            if child.id is not None and child.id in path:
+                continue
+
+            child_level = node_level + 1
+            yield child, child_level
+            if level is not None and child_level >= level:
+                continue
+            if child.id is not None:
+                path.add(child.id)
+            stack.append((child, child_level, iter(children_map.get(child.id, ()))))
+
+    def walk(self, level: Optional[int] = None) -> Iterator[ActionDocument]:
+        for doc, _ in self._walk_levels(level):
+            yield doc
 
     def __repr__(self) -> str:
         if not self.docs:
             return f"ActionTraces(action='{self.action}', status='No documents found')"
 
-        root_doc = self.get_root_doc()
-        if not root_doc:
+        if not self.root_doc:
             return f"ActionTraces(action='{self.action}', status='No root document found')"
 
-        # Filter out docs with no ID to prevent errors and build the children map
-        docs_with_id = [doc for doc in self.docs if doc.id is not None]
-        children_map: Dict[str, List[ActionDocument]] = {doc.id: [] for doc in docs_with_id}
-        for doc in docs_with_id:
-            for parent_id in doc.ref_ids:
-                if parent_id in children_map:
-                    children_map[parent_id].append(doc)
-
-        # Sort children by timestamp for deterministic, chronological traversal
-        for parent_id in children_map:
-            children_map[parent_id].sort(key=lambda d: d.timestamp or datetime.min)
-
-        output_lines = []
-
-        def build_tree_string(node: ActionDocument, level: int = 0):
+        output_lines = [f"--- Call Chain Starting from action: {self.action} ---"]
+        for node, level in self._walk_levels():
             prefix = "    " * level
             if level > 0:
                 prefix = "    " * (level - 1) + "└── "
@@ -272,13 +460,6 @@ class ActionTraces:
 
             output_lines.append(f"{prefix}app: {node.app}, action: {node.action}, {context_str}")
 
-            children = children_map.get(node.id, [])
-            for child in children:
-                build_tree_string(child, level + 1)
-
-        output_lines.append(f"--- Call Chain Starting from action: {self.action} ---")
-        build_tree_string(root_doc)
-
         return "\n".join(output_lines)
 
 
@@ -292,13 +473,12 @@ class RecentActionResult:
 
 
 class RecentActions:
-    def __init__(self, size: int = 10, days: int = 30, path: Optional[str] = None):
+    def __init__(self, size: int = 10, days: int = 30, path: Optional[str] = None, es: Any = None):
         self.size = size
         self.days = days
         self.elastic_url = os.environ.get("ELASTIC_URL")
-        if not self.elastic_url:
-            raise ValueError("ELASTIC_URL environment variable is not set")
-        self.es = Elasticsearch(self.elastic_url)
+        # connected on fetch, loading saved actions works without ELASTIC_URL
+        self.es = es
         self.index = "action-*"
         if path and os.path.exists(path):
             self.actions = self.load(path)
@@ -378,6 +558,8 @@ class RecentActions:
                 }
             }
         }
+        if self.es is None:
+            self.es = get_elasticsearch(self.elastic_url)
         result = self.es.search(index=self.index, body=query)
         buckets = result["aggregations"]["top_actions"]["buckets"]
         return [RecentActionResult(b["key"], b["doc_count"]) for b in buckets]
@@ -0,0 +1,241 @@
+# @author: stephen
+
+import os
+import mmap
+import struct
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, Optional
+
+try:
+    import msgpack
+except ImportError:
+    # only needed by the binary AST cache, RepoJavaParser warns when it is requested
+    msgpack = None
+
+from .java_parser import JavaParseResult, ImportParseResult, ClassParseResult, MethodParseResult, FieldParseResult
+
+
+# file layout: magic, version, header length, msgpack header, then one msgpack record per file
+MAGIC = b"JAST"
+VERSION = 3
+_PREAMBLE = struct.Struct("<4sIQ")
+
+
+class StringTable:
+    """Interns repeated strings (packages, class names, modifiers, types) into a shared table."""
+
+    def __init__(self):
+        self.strings: list[str] = []
+        self.ids: Dict[str, int] = {}
+
+    def id(self, value: Optional[str]) -> Optional[int]:
+        if value is None:
+            return None
+        string_id = self.ids.get(value)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.ids[value] = string_id
+            self.strings.append(value)
+        return string_id
+
+
+def is_binary_cache(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_binary_cache_version(path: str) -> int:
+    with open(path, "rb") as f:
+        return _PREAMBLE.unpack(f.read(_PREAMBLE.size))[1]
+
+
+def _encode_result(result: JavaParseResult, table: StringTable) -> list:
+    s = table.id
+    return [
+        s(result.package),
+        s(result.root),
+        [[s(i.package), s(i.class_name)] for i in result.imports],
+        [s(i) for i in result.implicit_imports],
+        [[s(c.name), s(c.modifiers), s(c.type), c.type_parameters, s(c.superclass), s(c.interfaces),
+          [[m.name, s(m.modifiers), m.type_parameters, s(m.type), m.parameters, m.throws,
+            m.start_byte, m.end_byte, m.body_start_byte, m.body_end_byte,
+            None if m.body_references is None else [s(r) for r in m.body_references]]
+           for m in c.methods.values()],
+          [[s(f.modifiers), s(f.type), f.declarator] for f in c.fields]]
+         for c in result.classes]
+    ]
+
+
+def _decode_result(path: str, record: list, strings: list[str]) -> JavaParseResult:
+    def s(string_id: Optional[int]) -> Optional[str]:
+        return None if string_id is None else strings[string_id]
+
+    package, root, imports, implicit_imports, classes = record
+    result = JavaParseResult()
+    result.path = path
+    result.package = s(package)
+    result.root = s(root)
+    result.implicit_imports = [s(i) for i in implicit_imports]
+
+    result.imports = []
+    for import_package, import_class_name in imports:
+        import_result = ImportParseResult()
+        import_result.package = s(import_package)
+        import_result.class_name = s(import_class_name)
+        result.imports.append(import_result)
+
+    result.classes = []
+    for name, modifiers, class_type, type_parameters, superclass, interfaces, methods, fields in classes:
+        class_result = ClassParseResult()
+        class_result.name = s(name)
+        class_result.modifiers = s(modifiers)
+        class_result.type = s(class_type)
+        class_result.type_parameters = type_parameters
+        class_result.superclass = s(superclass)
+        class_result.interfaces = s(interfaces)
+
+        class_result.methods = {}
+        for (method_name, method_modifiers, method_type_parameters, method_type, parameters, throws,
+             start_byte, end_byte, body_start_byte, body_end_byte, body_references) in methods:
+            method_result = MethodParseResult()
+            method_result.name = method_name
+            method_result.modifiers = s(method_modifiers)
+            method_result.type_parameters = method_type_parameters
+            method_result.type = s(method_type)
+            method_result.parameters = parameters
+            method_result.throws = throws
+            method_result.start_byte = start_byte
+            method_result.end_byte = end_byte
+            method_result.body_start_byte = body_start_byte
+            method_result.body_end_byte = body_end_byte
+            method_result.body_references = None if body_references is None else [s(r) for r in body_references]
+            class_result.methods[method_name] = method_result
+
+        class_result.fields = []
+        for field_modifiers, field_type, declarator in fields:
+            field_result = FieldParseResult()
+            field_result.modifiers = s(field_modifiers)
+            field_result.type = s(field_type)
+            field_result.declarator = declarator
+            class_result.fields.append(field_result)
+
+        result.classes.append(class_result)
+    return result
+
+
+class LazyParseResults(MutableMapping):
+    """
+    Path -> JavaParseResult mapping backed by a memory-mapped binary cache.
+
+    A record is only deserialized the first time its path is accessed,
+    results set afterwards replace the cached record.
+    """
+
+    def __init__(self, mapped: mmap.mmap, data_offset: int, strings: list[str], offsets: Dict[str, Optional[tuple[int, int]]],
+                 stats: Dict[str, dict]):
+        self._mapped = mapped
+        self._data_offset = data_offset
+        self._strings = strings
+        self._offsets = offsets
+        self._stats = stats
+        self._loaded: Dict[str, JavaParseResult] = {}
+
+    def __getitem__(self, path: str) -> JavaParseResult:
+        result = self._loaded.get(path)
+        if result is None:
+            offset, length = self._offsets[path]
+            start = self._data_offset + offset
+            record = msgpack.unpackb(self._mapped[start:start + length])
+            result = _decode_result(path, record, self._strings)
+            result.source_stat = self._stats.get(path)
+            self._loaded[path] = result
+        return result
+
+    def __setitem__(self, path: str, result: JavaParseResult) -> None:
+        if path not in self._offsets:
+            self._offsets[path] = None
+        self._loaded[path] = result
+
+    def __delitem__(self, path: str) -> None:
+        del self._offsets[path]
+        self._loaded.pop(path, None)
+
+    def __contains__(self, path) -> bool:
+        return path in self._offsets
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+
+class BinaryAstCache:
+    def __init__(self, results: LazyParseResults, stats: Dict[str, dict], class_index: Dict[tuple[str, str], str],
+                 import_references: Dict[tuple[str, str], list[str]], implicit_import_references: Dict[tuple[str, str], list[str]]):
+        self.results = results
+        self.stats = stats
+        self.class_index = class_index
+        self.import_references = import_references
+        self.implicit_import_references = implicit_import_references
+
+
+def save_binary_cache(path: str, results: MutableMapping, stats: Dict[str, dict], class_index: Dict[tuple[str, str], str],
+                      import_references: Dict[tuple[str, str], list[str]], implicit_import_references: Dict[tuple[str, str], list[str]]) -> None:
+    table = StringTable()
+    paths = list(results.keys())
+    path_ids = {p: i for i, p in enumerate(paths)}
+
+    records = bytearray()
+    offsets = []
+    for p in paths:
+        record = msgpack.packb(_encode_result(results[p], table))
+        offsets.append([len(records), len(record)])
+        records += record
+
+    def encode_references(references: Dict[tuple[str, str], list[str]]) -> list:
+        return [[table.id(package), table.id(class_name), [path_ids[p] for p in ref_paths]]
+                for (package, class_name), ref_paths in references.items()]
+
+    stat_keys = ("mtime", "size", "hash")
+    header = msgpack.packb({
+        "paths": paths,
+        "offsets": offsets,
+        "stats": [[stats[p][k] for k in stat_keys] if p in stats else None for p in paths],
+        "classes": [[table.id(package), table.id(class_name), path_ids[p]] for (package, class_name), p in class_index.items()],
+        "imports": encode_references(import_references),
+        "implicit_imports": encode_references(implicit_import_references),
+        # the table is complete only after all records and indexes are encoded
+        "strings": table.strings,
+    })
+
+    # write aside and swap, a previous cache of the same path may still be memory-mapped
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        f.write(records)
+    os.replace(tmp_path, path)
+
+
+def load_binary_cache(path: str) -> BinaryAstCache:
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, header_length = _PREAMBLE.unpack_from(mapped, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unsupported binary AST cache {path}, version={version}")
+    header = msgpack.unpackb(mapped[_PREAMBLE.size:_PREAMBLE.size + header_length])
+    strings = header["strings"]
+    paths = header["paths"]
+
+    offsets = {p: tuple(offset) for p, offset in zip(paths, header["offsets"])}
+    stats = {p: {"mtime": stat[0], "size": stat[1], "hash": stat[2]} for p, stat in zip(paths, header["stats"]) if stat}
+    results = LazyParseResults(mapped, _PREAMBLE.size + header_length, strings, offsets, stats)
+    class_index = {(strings[package], strings[class_name]): paths[path_id] for package, class_name, path_id in header["classes"]}
+
+    def decode_references(references: list) -> Dict[tuple[str, str], list[str]]:
+        return {(None if package is None else strings[package], strings[class_name]): [paths[i] for i in path_ids]
+                for package, class_name, path_ids in references}
+
+    return BinaryAstCache(results, stats, class_index, decode_references(header["imports"]), decode_references(header["implicit_imports"]))
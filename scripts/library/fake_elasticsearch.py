@@ -0,0 +1,151 @@
+# @author: stephen
+
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+
+def _values(doc: Dict[str, Any], field: str) -> list:
+    value = doc.get(field)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def _source(doc: Dict[str, Any], fields: Any) -> Dict[str, Any]:
+    if fields is None or fields is True:
+        return doc
+    source: Dict[str, Any] = {}
+    for field in fields:
+        value, path = doc, field.split(".")
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = source
+            for key in path[:-1]:
+                target = target.setdefault(key, {})
+            target[path[-1]] = value
+    return source
+
+
+def _is_after(values: list, search_after: list, orders: List[str]) -> bool:
+    for value, after, order in zip(values, search_after, orders):
+        if value != after:
+            return value > after if order == "asc" else value < after
+    return False
+
+
+def _matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    if not query or "match_all" in query:
+        return True
+    (kind, clause), = query.items()
+    if kind in ("match", "term"):
+        (field, value), = clause.items()
+        if isinstance(value, dict):
+            value = value.get("query", value.get("value"))
+        return value in _values(doc, field)
+    if kind == "terms":
+        (field, values), = clause.items()
+        return any(v in values for v in _values(doc, field))
+    if kind == "prefix":
+        (field, prefix), = clause.items()
+        return any(str(v).startswith(prefix) for v in _values(doc, field))
+    if kind == "range":
+        (field, bounds), = clause.items()
+        values = _values(doc, field)
+        return any(("gte" not in bounds or v >= bounds["gte"]) and ("lte" not in bounds or v <= bounds["lte"]) for v in values)
+    if kind == "bool":
+        if not all(_matches(doc, q) for q in clause.get("must", []) + clause.get("filter", [])):
+            return False
+        if any(_matches(doc, q) for q in clause.get("must_not", [])):
+            return False
+        should = clause.get("should", [])
+        return not should or sum(_matches(doc, q) for q in should) >= clause.get("minimum_should_match", 1)
+    raise ValueError(f"Unsupported query: {kind}")
+
+
+class FakeElasticsearch:
+    """
+    In-memory stand-in for the Elasticsearch client, serving the queries of action_trace from a list of documents.
+
+    Plug it in with configure_elasticsearch(client=FakeElasticsearch(docs)) to run without a cluster,
+    requests counts the round trips made, latency (seconds) simulates the network time of each one.
+    Points in time are snapshots of the document list, search_after and _source filtering work as in Elasticsearch.
+    """
+
+    def __init__(self, docs: List[Dict[str, Any]], latency: float = 0):
+        self.docs = docs
+        self.latency = latency
+        self.requests = 0
+        self.points_in_time: Dict[str, List[Dict[str, Any]]] = {}
+
+    def _round_trip(self) -> None:
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def search(self, index: Optional[str] = None, body: Optional[Dict[str, Any]] = None, **kwargs) -> Dict[str, Any]:
+        self._round_trip()
+        return self._search({**(body or {}), **kwargs})
+
+    def open_point_in_time(self, index: Optional[str] = None, keep_alive: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        self._round_trip()
+        pit_id = f"pit-{len(self.points_in_time)}"
+        self.points_in_time[pit_id] = list(self.docs)
+        return {"id": pit_id}
+
+    def close_point_in_time(self, id: str, **kwargs) -> Dict[str, Any]:
+        self._round_trip()
+        return {"succeeded": self.points_in_time.pop(id, None) is not None, "num_freed": 1}
+
+    def msearch(self, index: Optional[str] = None, searches: Optional[List[Dict[str, Any]]] = None,
+                body: Optional[List[Dict[str, Any]]] = None, **kwargs) -> Dict[str, Any]:
+        self._round_trip()
+        searches = searches if searches is not None else body
+        # header and body lines alternate
+        return {"responses": [{**self._search(search), "status": 200} for search in searches[1::2]]}
+
+    def _search(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        docs = self.docs
+        if "pit" in body:
+            docs = self.points_in_time[body["pit"]["id"]]
+        # the position in the list stands for _shard_doc
+        hits = [(position, doc) for position, doc in enumerate(docs) if _matches(doc, body.get("query"))]
+        total = len(hits)
+
+        fields, orders = [], []
+        for sort in body.get("sort", []):
+            (field, order), = sort.items()
+            fields.append(field)
+            orders.append(order.get("order", "asc") if isinstance(order, dict) else order)
+
+        def sort_values(position: int, doc: Dict[str, Any]) -> list:
+            return [position if field == "_shard_doc" else doc.get(field) or "" for field in fields]
+
+        for i in reversed(range(len(fields))):
+            hits.sort(key=lambda hit: sort_values(*hit)[i], reverse=orders[i] == "desc")
+        if "search_after" in body:
+            hits = [hit for hit in hits if _is_after(sort_values(*hit), body["search_after"], orders)]
+
+        result: Dict[str, Any] = {"hits": {"total": {"value": min(total, 10000), "relation": "eq" if total <= 10000 else "gte"}, "hits": []}}
+        if "pit" in body:
+            result["pit_id"] = body["pit"]["id"]
+        start = body.get("from", 0)
+        for position, doc in hits[start:start + body.get("size", 10)]:
+            result["hits"]["hits"].append({"_index": "action", "_id": doc.get("id"), "_source": _source(doc, body.get("_source")),
+                                           "sort": sort_values(position, doc)})
+        hits = [doc for _, doc in hits]
+
+        aggregations = {}
+        for name, aggregation in body.get("aggs", {}).items():
+            terms = aggregation["terms"]
+            counts = Counter(v for doc in hits for v in _values(doc, terms["field"]))
+            aggregations[name] = {"buckets": [{"key": key, "doc_count": count} for key, count in counts.most_common(terms.get("size", 10))]}
+        if aggregations:
+            result["aggregations"] = aggregations
+        return result
+
+    def close(self) -> None:
+        pass
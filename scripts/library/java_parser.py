@@ -1,8 +1,17 @@
 # @author: stephen
 
+import hashlib
+import os
 import tree_sitter_java as tsj
+from operator import attrgetter
 from pathlib import Path
-from tree_sitter import Language, Parser, Node
+from sys import intern
+from tree_sitter import Language, Parser, Node, Query
+
+try:
+    from tree_sitter import QueryCursor
+except ImportError:  # tree-sitter < 0.25 runs captures on the query itself
+    QueryCursor = None
 
 
 
@@ -16,6 +25,27 @@ JAVA_LANG_CLASSES = {
     "Deprecated", "SuppressWarnings", "Class", "ClassLoader"
 }
 JAVA_PRIMITIVE_TYPES = {"byte", "short", "int", "long", "float", "double", "boolean", "char", "void", "var"}
+CLASS_DECLARATION_TYPES = (
+    "class_declaration", "interface_declaration", "enum_declaration", "record_declaration", "annotation_type_declaration"
+)
+# node kind ids let the tree walker compare ints instead of building a type string per node
+IDENTIFIER_KIND_ID = LANGUAGE.id_for_node_kind("identifier", True)
+TYPE_IDENTIFIER_KIND_ID = LANGUAGE.id_for_node_kind("type_identifier", True)
+PACKAGE_DECLARATION_KIND_ID = LANGUAGE.id_for_node_kind("package_declaration", True)
+IMPORT_DECLARATION_KIND_ID = LANGUAGE.id_for_node_kind("import_declaration", True)
+FIELD_DECLARATION_KIND_ID = LANGUAGE.id_for_node_kind("field_declaration", True)
+METHOD_DECLARATION_KIND_ID = LANGUAGE.id_for_node_kind("method_declaration", True)
+CLASS_DECLARATION_KIND_IDS = {LANGUAGE.id_for_node_kind(t, True) for t in CLASS_DECLARATION_TYPES}
+# captures everything the "query" engine of JavaParser extracts, matched in one pass by tree-sitter
+JAVA_QUERY = Query(LANGUAGE, """
+(package_declaration) @package
+(import_declaration) @import
+[(class_declaration) (interface_declaration) (enum_declaration) (record_declaration) (annotation_type_declaration)] @class
+(field_declaration) @field
+(method_declaration) @method
+[(identifier) (type_identifier)] @identifier
+""")
+JAVA_PARSER_ENGINES = ("cursor", "query")
 
 
 class MethodBodyParseResult:
@@ -27,7 +57,22 @@ class MethodBodyParseResult:
         return f"MethodBodyParseResult(body={self.body}, references={self.references})"
 
 
-class MethodParseResult:
+class ParseResult:
+    """
+    Base of the parse results kept for every file of a repository. Attributes are declared in __slots__
+    to avoid a __dict__ per object, and the strings repeated across files (packages, class names,
+    modifiers, types) are interned by JavaParser and RepoJavaParser.
+    """
+    __slots__ = ()
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class MethodParseResult(ParseResult):
+    __slots__ = ("name", "modifiers", "type_parameters", "type", "parameters", "throws",
+                 "start_byte", "end_byte", "body_start_byte", "body_end_byte", "body_references")
+
     def __init__(self):
         self.name: str = ""
         self.modifiers: str = ""
@@ -35,6 +80,13 @@ class MethodParseResult:
         self.type: str = ""
         self.parameters: str = ""
         self.throws: str = ""
+        # byte ranges of the declaration and its body in the source file, the body range is empty without body
+        self.start_byte: int = 0
+        self.end_byte: int = 0
+        self.body_start_byte: int = 0
+        self.body_end_byte: int = 0
+        # identifiers and type identifiers used in the body, None if not recorded (e.g. loaded from an old ast cache)
+        self.body_references: list[str] | None = None
 
     def __repr__(self):
         parts = []
@@ -53,7 +105,9 @@ class MethodParseResult:
         return " ".join(parts) + ";"
 
 
-class FieldParseResult:
+class FieldParseResult(ParseResult):
+    __slots__ = ("modifiers", "type", "declarator")
+
     def __init__(self):
         self.modifiers: str = ""
         self.type: str = ""
@@ -70,7 +124,9 @@ class FieldParseResult:
         return " ".join(parts) + ";"
 
 
-class ClassParseResult:
+class ClassParseResult(ParseResult):
+    __slots__ = ("name", "modifiers", "type", "type_parameters", "superclass", "interfaces", "methods", "fields")
+
     def __init__(self):
         self.name: str = ""
         self.modifiers: str = ""
@@ -108,7 +164,9 @@ class ClassParseResult:
             parts.append(self.interfaces)
         return " ".join(parts) + " {\n" + "\n".join(["    " + str(m) for m in self.methods.values()]) + "\n}" 
 
-class ImportParseResult:
+class ImportParseResult(ParseResult):
+    __slots__ = ("package", "class_name")
+
     def __init__(self):
         self.package: str | None = ""
         self.class_name: str = ""
@@ -116,7 +174,9 @@ class ImportParseResult:
     def __repr__(self):
         return "import " + self.package + "." + self.class_name + ";"
 
-class JavaParseResult:
+class JavaParseResult(ParseResult):
+    __slots__ = ("path", "package", "root", "imports", "implicit_imports", "classes", "source_stat")
+
     def __init__(self):
         self.path: str = ""
         self.package: str = ""
@@ -124,7 +184,17 @@ class JavaParseResult:
         self.imports: list[ImportParseResult] = []
         self.implicit_imports: list[str] = []
         self.classes: list[ClassParseResult] = []
-    
+        # {"mtime", "size"[, "hash"]} of the file content the byte ranges were recorded from, not saved in the AST cache
+        self.source_stat: dict | None = None
+
+    def to_dict(self) -> dict:
+        # source_stat is restored from the stats saved next to the files in the AST cache
+        return {name: getattr(self, name) for name in self.__slots__ if name != "source_stat"}
+
+    def __repr__(self):
+        header = f"package {self.package};\n\n" if self.package else ""
+        return header + "\n\n".join([str(c) for c in self.classes])
+
     def get_import_by_class_name(self, class_name: str) -> ImportParseResult | None:
         for i in self.imports:
             if i.class_name == class_name:
@@ -172,8 +242,21 @@ class JavaParseResult:
         return references
 
     def get_method_body(self, class_name: str, method_name: str) -> MethodBodyParseResult:
-        parser = JavaBodyParser(self.path)
-        return parser.parse(class_name, method_name)
+        cls = self.get_class_by_name(class_name)
+        method = cls.methods.get(method_name) if cls else None
+        if method is None or method.body_references is None:
+            parser = JavaBodyParser(self.path)
+            return parser.parse(class_name, method_name)
+
+        # body range and references were recorded by JavaParser, only read the body text back
+        result = MethodBodyParseResult()
+        result.references = list(method.body_references)
+        if method.body_end_byte > method.body_start_byte:
+            result.body = read_source_range(self.path, method.body_start_byte, method.body_end_byte, self.source_stat)
+            if result.body is None:
+                # the file changed since it was parsed, the recorded range is stale
+                return JavaBodyParser(self.path).parse(class_name, method_name)
+        return result
 
     def _get_method_body_references(self, class_name: str, method_name: str) -> list[ImportParseResult]:
         body = self.get_method_body(class_name, method_name)
@@ -262,19 +345,10 @@ class JavaBodyParser:
         body_node = method_node.child_by_field_name("body")
         if body_node:
             self.result.body = body_node.text.decode('utf-8')
-            self._collect_identifier_and_type_identifier(body_node, self.result.references)
+            self.result.references = collect_identifiers(body_node)
 
         return self.result
 
-    # noinspection PyMethodMayBeStatic
-    def _collect_identifier_and_type_identifier(self, node, refs):
-        if node.type == "type_identifier" or node.type == "identifier":
-            type_name = node.text.decode("utf-8")
-            if type_name not in refs:
-                refs.append(type_name)
-        for child in node.children:
-            self._collect_identifier_and_type_identifier(child, refs)
-
 
     def _find_method_node(self, node, class_name: str, method_name: str, current_class=None):
         if node.type in (
@@ -295,33 +369,20 @@ class JavaBodyParser:
         return None
 
 
-class JavaFieldParser:
-    def __init__(self, content: str = None):
-        self.result = None
-        self.parser = Parser(LANGUAGE)
-        if content is not None:
-            self.parse(content)
-    
-    def parse(self, content: str):
-        if self.result is not None: return self.result
-        
-        self.result = FieldParseResult()
-        
-        tree = self.parser.parse(content.encode())
-        node = tree.root_node.children[0]
-        if node.children[0].type == "modifiers":
-            self.result.modifiers = node.children[0].text.decode('utf-8')
-        self.result.type = node.child_by_field_name("type").text.decode('utf-8')
-        self.result.declarator = node.child_by_field_name("declarator").text.decode('utf-8')
-        
-    def is_inject(self):
-        return "@Inject" in self.result.modifiers
-
-
 class JavaParser:
-    def __init__(self, path: str = None):
+    def __init__(self, path: str = None, parser: Parser = None, engine: str = "cursor"):
+        """
+        Args:
+            path: Path of the Java file to parse
+            parser: tree-sitter parser to reuse, a new one is created if not provided
+            engine: "cursor" walks the tree node by node, "query" matches the nodes with a precompiled tree-sitter query,
+                    both produce the same JavaParseResult
+        """
+        if engine not in JAVA_PARSER_ENGINES:
+            raise ValueError(f"Unsupported engine {engine}, expected one of {JAVA_PARSER_ENGINES}")
         self.result = None
-        self.parser = Parser(LANGUAGE)
+        self.parser = parser or Parser(LANGUAGE)
+        self.engine = engine
         if path is not None:
             self.parse(path)
 
@@ -334,6 +395,8 @@ class JavaParser:
         try:
             with open(path, "rb") as file:
                 source_bytes = file.read()
+                stat = os.fstat(file.fileno())
+            self.result.source_stat = {"mtime": stat.st_mtime_ns, "size": stat.st_size}
         except FileNotFoundError:
             print(f"Error: File not found at {path}")
             return self.result 
@@ -344,7 +407,10 @@ class JavaParser:
         tree = self.parser.parse(source_bytes)
         root_node = tree.root_node
 
-        self._traverse_tree(root_node, self.result)
+        if self.engine == "query":
+            self._traverse_query(root_node, self.result)
+        else:
+            self._traverse_tree(root_node, self.result)
         return self.result
 
 
@@ -365,6 +431,13 @@ class JavaParser:
 
     
     def _get_method_block(self, class_name: str, method_name: str) -> str:
+        target_class = self._find_class(class_name)
+        method_result = target_class.methods.get(method_name) if target_class else None
+        if method_result and method_result.end_byte > method_result.start_byte:
+            block = read_source_range(self.result.path, method_result.start_byte, method_result.end_byte, self.result.source_stat)
+            if block is not None:
+                return block
+
         with open(self.result.path, "rb") as file:
             source_bytes = file.read()
             tree = self.parser.parse(source_bytes)
@@ -492,73 +565,175 @@ class JavaParser:
 
         return self._get_method_imports(class_name, method_name, body + " " + related_fields)
 
-    def _traverse_tree(self, node: Node, rst: JavaParseResult, current_class: ClassParseResult = None):
-        if node.type == "identifier":
-            identifier = node.text.decode('utf-8')
-            if identifier[0].isupper() \
-                    and identifier not in JAVA_LANG_CLASSES \
-                    and identifier not in JAVA_PRIMITIVE_TYPES \
-                    and identifier not in rst.implicit_imports \
-                    and identifier not in [i.class_name for i in rst.imports]:
-                rst.implicit_imports.append(identifier)
-
-        elif node.type == "type_identifier":
-            type_identifier = node.text.decode('utf-8')
-            if type_identifier[0].isupper() \
-                    and type_identifier not in JAVA_LANG_CLASSES \
-                    and type_identifier not in JAVA_PRIMITIVE_TYPES \
-                    and type_identifier not in rst.implicit_imports \
-                    and type_identifier not in [i.class_name for i in rst.imports]:
-                rst.implicit_imports.append(type_identifier)
-
+    def _traverse_tree(self, node: Node, rst: JavaParseResult) -> None:
+        """
+        Walk the tree in document order with a TreeCursor, collecting the package, imports,
+        classes with their fields and methods, and the implicit imports of the file.
+        """
+        import_class_names = {i.class_name for i in rst.imports}
+        implicit_imports = set(rst.implicit_imports)
+        # enclosing class declarations and method bodies of the current node, with the depth of their declaration node
+        classes: list[tuple[int, ClassParseResult]] = []
+        methods: list[tuple[int, int, MethodParseResult, set[str]]] = []
+
+        cursor = node.walk()
+        depth = 0
+        while True:
+            current = cursor.node
+            kind_id = current.kind_id
+            while classes and classes[-1][0] >= depth:
+                classes.pop()
+            while methods and methods[-1][0] >= depth:
+                methods.pop()
+            current_class = classes[-1][1] if classes else None
+
+            if kind_id == IDENTIFIER_KIND_ID or kind_id == TYPE_IDENTIFIER_KIND_ID:
+                identifier = intern(current.text.decode('utf-8'))
+                if identifier[0].isupper() \
+                        and identifier not in JAVA_LANG_CLASSES \
+                        and identifier not in JAVA_PRIMITIVE_TYPES \
+                        and identifier not in implicit_imports \
+                        and identifier not in import_class_names:
+                    rst.implicit_imports.append(identifier)
+                    implicit_imports.add(identifier)
+                for _, body_start_byte, method, body_references in methods:
+                    if current.start_byte >= body_start_byte and identifier not in body_references:
+                        method.body_references.append(identifier)
+                        body_references.add(identifier)
+
+            elif kind_id == PACKAGE_DECLARATION_KIND_ID:
+                package_name_node = current.named_children[0]
+                if package_name_node:
+                    rst.package = intern(package_name_node.text.decode('utf-8'))
+
+            elif kind_id == IMPORT_DECLARATION_KIND_ID:
+                import_result = self._build_import_import_result(current.text.decode('utf-8'))
+                rst.imports.append(import_result)
+                import_class_names.add(import_result.class_name)
+
+            elif kind_id in CLASS_DECLARATION_KIND_IDS:
+                new_class = self._build_class_parse_result(current)
+                rst.classes.append(new_class)
+                if not current_class:
+                    rst.root = new_class.name
+                classes.append((depth, new_class))
+
+            elif kind_id == FIELD_DECLARATION_KIND_ID:
+                if current_class:
+                    current_class.fields.extend(self._build_field_parse_results(current))
+
+            elif kind_id == METHOD_DECLARATION_KIND_ID:
+                if current_class:
+                    method_result = self._build_method_parse_result(current)
+                    # the first declaration of a name wins, as in JavaBodyParser, later ones are overloads or methods of anonymous classes
+                    if method_result.name not in current_class.methods:
+                        current_class.methods[method_result.name] = method_result
+                        if method_result.body_end_byte > method_result.body_start_byte:
+                            methods.append((depth, method_result.body_start_byte, method_result, set()))
+
+            if cursor.goto_first_child():
+                depth += 1
+                continue
+            while not cursor.goto_next_sibling():
+                if not cursor.goto_parent():
+                    return
+                depth -= 1
+
+    def _traverse_query(self, node: Node, rst: JavaParseResult) -> None:
+        """
+        Same extraction as _traverse_tree, but the nodes are matched by JAVA_QUERY in C,
+        python only visits the captured nodes and replays them in document order.
+        """
+        captures = QueryCursor(JAVA_QUERY).captures(node) if QueryCursor else JAVA_QUERY.captures(node)
+        by_start = attrgetter("start_byte")
 
-        elif node.type == "package_declaration":
-            package_name_node = node.named_children[0]
+        for package_node in sorted(captures.get("package", []), key=by_start):
+            package_name_node = package_node.named_children[0]
             if package_name_node:
-                rst.package = package_name_node.text.decode('utf-8')
+                rst.package = intern(package_name_node.text.decode('utf-8'))
 
-        elif node.type == "import_declaration":
-            import_text = node.text.decode('utf-8')
-            rst.imports.append(self._build_import_import_result(import_text))
+        imports = []
+        for import_node in sorted(captures.get("import", []), key=by_start):
+            import_result = self._build_import_import_result(import_node.text.decode('utf-8'))
+            rst.imports.append(import_result)
+            imports.append((import_node.start_byte, import_result.class_name))
 
-        elif (node.type == "class_declaration" 
-                or node.type == "interface_declaration" 
-                or node.type == "enum_declaration" 
-                or node.type == "record_declaration"
-                or node.type == "annotation_type_declaration"):
-            new_class = self._build_class_parse_result(node)
+        classes = {}
+        for class_node in sorted(captures.get("class", []), key=by_start):
+            new_class = self._build_class_parse_result(class_node)
             rst.classes.append(new_class)
-            if not current_class:
+            if not self._find_enclosing_class(class_node, classes):
                 rst.root = new_class.name
-            # Recursively traverse children with the new class context
-            for child in node.children:
-                self._traverse_tree(child, rst, current_class=new_class)
-            return  # Important: return here to avoid double traversal
+            classes[class_node.id] = new_class
 
-        elif node.type == "field_declaration":
+        for field_node in sorted(captures.get("field", []), key=by_start):
+            current_class = self._find_enclosing_class(field_node, classes)
             if current_class:
-                field_text = node.text.decode('utf-8').strip()
-                current_class.fields.append(JavaFieldParser(field_text).result)
+                current_class.fields.extend(self._build_field_parse_results(field_node))
 
-        elif node.type == "method_declaration":
+        method_bodies = []
+        for method_node in sorted(captures.get("method", []), key=by_start):
+            current_class = self._find_enclosing_class(method_node, classes)
             if current_class:
-                method_result = self._build_method_parse_result(node)
-                current_class.methods[method_result.name] = method_result
-
-        # Continue traversal for other nodes
-        for child in node.children:
-            self._traverse_tree(child, rst, current_class)
+                method_result = self._build_method_parse_result(method_node)
+                # the first declaration of a name wins, as in _traverse_tree
+                if method_result.name not in current_class.methods:
+                    current_class.methods[method_result.name] = method_result
+                    if method_result.body_end_byte > method_result.body_start_byte:
+                        method_bodies.append(method_result)
+
+        # sweep identifiers in document order, an import only hides the identifiers after it, like in _traverse_tree
+        import_class_names = set()
+        implicit_imports = set()
+        next_import = 0
+        next_body = 0
+        open_bodies: list[tuple[MethodParseResult, set[str]]] = []
+        for identifier_node in sorted(captures.get("identifier", []), key=by_start):
+            start_byte = identifier_node.start_byte
+            while next_import < len(imports) and imports[next_import][0] < start_byte:
+                import_class_names.add(imports[next_import][1])
+                next_import += 1
+            # method bodies are either nested or disjoint, so the open ones form a stack
+            while next_body < len(method_bodies) and method_bodies[next_body].body_start_byte <= start_byte:
+                method = method_bodies[next_body]
+                while open_bodies and open_bodies[-1][0].body_end_byte <= method.body_start_byte:
+                    open_bodies.pop()
+                open_bodies.append((method, set()))
+                next_body += 1
+            while open_bodies and open_bodies[-1][0].body_end_byte <= start_byte:
+                open_bodies.pop()
+
+            identifier = intern(identifier_node.text.decode('utf-8'))
+            if identifier[0].isupper() \
+                    and identifier not in JAVA_LANG_CLASSES \
+                    and identifier not in JAVA_PRIMITIVE_TYPES \
+                    and identifier not in implicit_imports \
+                    and identifier not in import_class_names:
+                rst.implicit_imports.append(identifier)
+                implicit_imports.add(identifier)
+            for method, body_references in open_bodies:
+                if identifier not in body_references:
+                    method.body_references.append(identifier)
+                    body_references.add(identifier)
 
+    # noinspection PyMethodMayBeStatic
+    def _find_enclosing_class(self, node: Node, classes: dict[int, ClassParseResult]) -> ClassParseResult | None:
+        parent = node.parent
+        while parent is not None:
+            if parent.kind_id in CLASS_DECLARATION_KIND_IDS:
+                return classes.get(parent.id)
+            parent = parent.parent
+        return None
 
     # noinspection PyMethodMayBeStatic
     def _build_class_parse_result(self, node: Node) -> ClassParseResult:
         clazz = ClassParseResult()
-        clazz.type = node.type
+        clazz.type = intern(node.type)
         if node.children[0].type == "modifiers":
-            clazz.modifiers = node.children[0].text.decode('utf-8')
+            clazz.modifiers = intern(node.children[0].text.decode('utf-8'))
         name_node = node.child_by_field_name('name')
         if name_node:
-            clazz.name = name_node.text.decode('utf-8')
+            clazz.name = intern(name_node.text.decode('utf-8'))
         type_parameters_node = node.child_by_field_name("type_parameters")
         if type_parameters_node:
             clazz.type_parameters = type_parameters_node.text.decode("utf-8")
@@ -570,11 +745,25 @@ class JavaParser:
             clazz.interfaces = interfaces_node.text.decode("utf-8")
         return clazz
 
+    # noinspection PyMethodMayBeStatic
+    def _build_field_parse_results(self, node: Node) -> list[FieldParseResult]:
+        """Build one FieldParseResult per declarator of the field declaration, e.g. "int a, b;" declares a and b."""
+        modifiers = intern(node.children[0].text.decode('utf-8')) if node.children[0].type == "modifiers" else ""
+        field_type = intern(node.child_by_field_name("type").text.decode('utf-8'))
+        fields = []
+        for declarator_node in node.children_by_field_name("declarator"):
+            field = FieldParseResult()
+            field.modifiers = modifiers
+            field.type = field_type
+            field.declarator = declarator_node.text.decode('utf-8')
+            fields.append(field)
+        return fields
+
     # noinspection PyMethodMayBeStatic
     def _build_method_parse_result(self, node: Node) -> MethodParseResult:
         method = MethodParseResult()
         if node.children[0].type == "modifiers":
-            method.modifiers = node.children[0].text.decode('utf-8')
+            method.modifiers = intern(node.children[0].text.decode('utf-8'))
         name_node = node.child_by_field_name('name')
         if name_node:
             method.name = name_node.text.decode('utf-8')
@@ -583,13 +772,21 @@ class JavaParser:
             method.parameters = parameters_node.text.decode('utf-8')
         type_node = node.child_by_field_name('type')
         if type_node:
-            method.type = type_node.text.decode('utf-8')
+            method.type = intern(type_node.text.decode('utf-8'))
         type_parameters_node = node.child_by_field_name('type_parameters')
         if type_parameters_node:
             method.type = type_parameters_node.text.decode('utf-8')
         throws_node = node.child_by_field_name('throws')
         if throws_node:
             method.type = throws_node.text.decode('utf-8')
+        method.start_byte = node.start_byte
+        method.end_byte = node.end_byte
+        body_node = node.child_by_field_name('body')
+        if body_node:
+            method.body_start_byte = body_node.start_byte
+            method.body_end_byte = body_node.end_byte
+        # filled with the identifiers of the body while _traverse_tree walks it
+        method.body_references = []
         return method
 
     # noinspection PyMethodMayBeStatic
@@ -602,14 +799,55 @@ class JavaParser:
             import_text = import_text.replace("import", "").strip()
         parts = import_text.split(".")
         if len(parts) > 1:
-            import_result.package = ".".join(parts[:-1])
-            import_result.class_name = parts[-1]
+            import_result.package = intern(".".join(parts[:-1]))
+            import_result.class_name = intern(parts[-1])
         else:
             import_result.package = None
-            import_result.class_name = parts[0]
+            import_result.class_name = intern(parts[0])
         return import_result
 
 
+def collect_identifiers(node: Node) -> list[str]:
+    """Collect the distinct identifiers and type identifiers under the node, in source order."""
+    refs = {}
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        if current.type == "type_identifier" or current.type == "identifier":
+            refs.setdefault(current.text.decode("utf-8"))
+        stack.extend(reversed(current.children))
+    return list(refs)
+
+
+def is_source_unchanged(path: str, source_stat: dict | None) -> bool:
+    """Whether the file still has the content described by source_stat, compared by mtime and size, then by hash if recorded."""
+    if not source_stat:
+        return False
+    stat = os.stat(path)
+    if stat.st_size != source_stat["size"]:
+        return False
+    if stat.st_mtime_ns == source_stat["mtime"]:
+        return True
+    if "hash" not in source_stat:
+        return False
+    with open(path, "rb") as file:
+        return hashlib.sha1(file.read()).hexdigest() == source_stat["hash"]
+
+
+def read_source_range(path: str, start_byte: int, end_byte: int, source_stat: dict | None) -> str | None:
+    """
+    The text between the byte offsets recorded when the file was parsed, None if the file changed since then or cannot be read.
+    """
+    try:
+        if not is_source_unchanged(path, source_stat):
+            return None
+        with open(path, "rb") as file:
+            file.seek(start_byte)
+            return file.read(end_byte - start_byte).decode("utf-8")
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
 def path_to_class_name(path: str) -> str:
     return Path(path).stem
 
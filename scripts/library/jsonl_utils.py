@@ -0,0 +1,111 @@
+# @author: stephen
+
+import json
+import os
+import re
+from typing import Callable, Iterable, Iterator
+
+
+_CHUNK_SIZE = 1 << 20
+_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def is_json_array(path: str) -> bool:
+    """
+    Whether the file holds one JSON array (the old output format) instead of one JSON record per line.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        while True:
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                return False
+            stripped = chunk.lstrip()
+            if stripped:
+                return stripped[0] == '['
+
+
+def _read_json_array(f) -> Iterator[dict]:
+    decoder = json.JSONDecoder()
+    buffer = f.read(_CHUNK_SIZE).lstrip()[1:]  # skip '['
+    pos = 0
+    while True:
+        pos = _SEPARATOR.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the record is cut by the end of the chunk, read more unless the file is exhausted
+            chunk = f.read(_CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield record
+        pos = end
+
+
+def read_records(path: str) -> Iterator[dict]:
+    """
+    Streams the records of a JSONL file, a file holding one JSON array is read record by record as well.
+    """
+    json_array = is_json_array(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        if json_array:
+            yield from _read_json_array(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def append_records(path: str, records: Iterable[dict]) -> int:
+    """
+    Appends records as JSON lines, the file is flushed and fsync'd so an interrupted run keeps every appended record.
+    """
+    count = 0
+    with open(path, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+
+def write_records(path: str, records: Iterable[dict]) -> int:
+    """
+    Replaces the file with the records as JSON lines, written aside and swapped so readers never see a partial file.
+    """
+    tmp_path = str(path) + ".tmp"
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return count
+
+
+def load_processed_keys(path: str, key: Callable[[dict], str]) -> set[str]:
+    """
+    Reads the output file once and returns the keys of the records already generated, used to resume a run.
+    """
+    if not os.path.exists(path):
+        return set()
+    return {key(record) for record in read_records(path)}
+
+
+def convert_json_array_to_jsonl(input_path: str, output_path: str = None) -> int:
+    """
+    Converts a file holding one JSON array into JSONL, in place if output_path is not given.
+    """
+    if not is_json_array(input_path):
+        print(f"{input_path} is already JSONL.")
+        return 0
+    count = write_records(output_path or input_path, read_records(input_path))
+    print(f"Converted {count} records of {input_path} to JSONL {output_path or input_path}")
+    return count
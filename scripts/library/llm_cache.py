@@ -0,0 +1,135 @@
+# @author: stephen
+
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Callable, Optional
+
+import litellm
+
+
+class LLMResponseCache:
+    """
+    On-disk cache of LLM responses in a SQLite file, keyed by a hash of the model, the messages and the call parameters.
+
+    A rerun with the same prompt is answered from the cache, so it costs nothing and works offline.
+    When the cache grows over max_size_mb, the least recently used responses are evicted.
+    """
+
+    def __init__(self, path: str = "llm-cache.sqlite", max_size_mb: int = 512):
+        self.path = path
+        self.max_size = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self.db.commit()
+
+    @staticmethod
+    def key(model: str, messages: list[dict], **params) -> str:
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, model: str, response: dict) -> None:
+        value = json.dumps(response, ensure_ascii=False)
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO responses (key, model, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, model, value, len(value), now, now))
+        self._evict()
+        self.db.commit()
+
+    def _evict(self) -> None:
+        size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if size <= self.max_size:
+            return
+        evicted = 0
+        for key, entry_size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            if size <= self.max_size:
+                break
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            size -= entry_size
+            evicted += 1
+        print(f"  - LLM cache: evicted {evicted} least recently used responses from {self.path}")
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def json_content(response: litellm.ModelResponse) -> str:
+    """
+    The text content of a response, without the markdown fences (```json ... ```) LLMs sometimes wrap JSON in.
+    """
+    content = response.choices[0].message.content
+    if content.strip().startswith("```json"):
+        content = content.strip()[7:-3].strip()
+    elif content.strip().startswith("```"):
+        content = content.strip()[3:-3].strip()
+    return content
+
+
+def is_json_response(response: litellm.ModelResponse) -> bool:
+    try:
+        json.loads(json_content(response))
+        return True
+    except (json.JSONDecodeError, TypeError):
+        return False
+
+
+def _mark_cache_hit(response: litellm.ModelResponse, cache_hit: bool) -> litellm.ModelResponse:
+    response._hidden_params["cache_hit"] = cache_hit
+    return response
+
+
+def cached_completion(cache: Optional[LLMResponseCache], model: str, messages: list[dict], validate: Callable[[litellm.ModelResponse], bool] = None,
+                      **params) -> litellm.ModelResponse:
+    """
+    litellm.completion answered from the cache when the same call was made before, cache None bypasses the cache.
+    Responses rejected by validate are not cached, so a rerun asks the LLM again.
+    """
+    if cache is None:
+        return _mark_cache_hit(litellm.completion(model=model, messages=messages, **params), False)
+    key = LLMResponseCache.key(model, messages, **params)
+    cached = cache.get(key)
+    if cached is not None:
+        return _mark_cache_hit(litellm.ModelResponse(**cached), True)
+    response = litellm.completion(model=model, messages=messages, **params)
+    if validate is None or validate(response):
+        cache.put(key, model, response.model_dump())
+    return _mark_cache_hit(response, False)
+
+
+async def acached_completion(cache: Optional[LLMResponseCache], model: str, messages: list[dict], validate: Callable[[litellm.ModelResponse], bool] = None,
+                             **params) -> litellm.ModelResponse:
+    """
+    Async version of cached_completion with litellm.acompletion.
+    """
+    if cache is None:
+        return _mark_cache_hit(await litellm.acompletion(model=model, messages=messages, **params), False)
+    key = LLMResponseCache.key(model, messages, **params)
+    cached = cache.get(key)
+    if cached is not None:
+        return _mark_cache_hit(litellm.ModelResponse(**cached), True)
+    response = await litellm.acompletion(model=model, messages=messages, **params)
+    if validate is None or validate(response):
+        cache.put(key, model, response.model_dump())
+    return _mark_cache_hit(response, False)
@@ -0,0 +1,147 @@
+# @author: stephen
+
+import re
+import zlib
+from array import array
+from typing import Iterable, Iterator
+
+_WORD = re.compile(r"\w+")
+_MASK64 = (1 << 64) - 1
+_EMPTY = 0xFFFFFFFF
+# records kept per LSH bucket, bounds the candidates checked for a text shared by many pairs (e.g. boilerplate)
+_BUCKET_CAPACITY = 16
+
+
+def shingle_hashes(text: str, size: int = 3) -> set[int]:
+    """
+    Hashes of the word n-grams of a text, case and punctuation insensitive.
+    """
+    words = [zlib.crc32(w.encode("utf-8")) for w in _WORD.findall(text.lower())]
+    if not words:
+        return set()
+    size = min(size, len(words))
+    shingles = set()
+    for i in range(len(words) - size + 1):
+        h = 0
+        for word in words[i:i + size]:
+            h = (h * 0x100000001B3 ^ word) & _MASK64
+        shingles.add(h)
+    return shingles
+
+
+def minhash(shingles: set[int], num_perm: int) -> array:
+    """
+    MinHash signature with one permutation hashing: every shingle is hashed once and kept as the minimum of
+    one of num_perm bins, empty bins borrow the value of the next non-empty bin.
+    The fraction of equal bins of two signatures estimates the Jaccard similarity of the shingle sets.
+    """
+    signature = array("I", [_EMPTY]) * num_perm
+    for x in shingles:
+        # splitmix64 finalizer inlined, spreads shingle hashes uniformly over 64 bits
+        x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & _MASK64
+        x = (x ^ (x >> 27)) * 0x94D049BB133111EB & _MASK64
+        x ^= x >> 31
+        i = x % num_perm
+        value = x >> 32
+        if value < signature[i]:
+            signature[i] = value
+    filled = [i for i in range(num_perm) if signature[i] != _EMPTY]
+    if filled and len(filled) < num_perm:
+        next_filled = filled[0]
+        for i in range(num_perm - 1, -1, -1):
+            if signature[i] != _EMPTY:
+                next_filled = i
+            else:
+                signature[i] = signature[next_filled]
+    return signature
+
+
+def _choose_bands(num_perm: int, threshold: float) -> int:
+    # the LSH s-curve threshold of b bands of r rows is about (1/b)^(1/r), pick the highest one well below the
+    # similarity threshold so near duplicates almost always share a band, false candidates are rejected on verification
+    bands = num_perm
+    for b in range(1, num_perm + 1):
+        if num_perm % b == 0 and (1 / b) ** (b / num_perm) <= threshold - 0.15:
+            return b
+    return bands
+
+
+class NearDuplicateFilter:
+    """
+    Drops records whose text is a near duplicate of a record kept before, in one pass over the records.
+
+    Texts are reduced to MinHash signatures of their word shingles. Signatures are split in bands, records sharing a
+    band are candidates (locality sensitive hashing), and a candidate is a duplicate if the exact Jaccard similarity
+    of the shingle sets is at least the threshold, the 8-byte shingle hashes of kept records are stored for it.
+    No pairwise comparison of all records is needed, so it scales to millions of pairs.
+    Texts without words (empty or missing fields) are never duplicates.
+    """
+
+    def __init__(self, fields: Iterable[str] = ("prompt",), threshold: float = 0.8, num_perm: int = 32, shingle_size: int = 3):
+        self.fields = (fields,) if isinstance(fields, str) else tuple(fields)
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands = _choose_bands(num_perm, threshold)
+        self.rows = num_perm // self.bands
+        # shingle hashes of the kept records, those of record i are shingles[offsets[i]:offsets[i + 1]]
+        self.shingles = array("Q")
+        self.offsets = array("Q", [0])
+        self.buckets: list[dict[int, int | list[int]]] = [{} for _ in range(self.bands)]
+        self.seen = 0
+        self.dropped = 0
+
+    def text(self, record: dict) -> str:
+        return "\n".join(str(record.get(field, "")) for field in self.fields)
+
+    def is_duplicate(self, text: str) -> bool:
+        """
+        Whether the text is a near duplicate of a kept text, the text is kept otherwise.
+        """
+        self.seen += 1
+        shingles = shingle_hashes(text, self.shingle_size)
+        if not shingles:
+            # every empty text has the same signature, but nothing to compare
+            return False
+        signature = minhash(shingles, self.num_perm)
+        keys = [hash(tuple(signature[b * self.rows:(b + 1) * self.rows])) for b in range(self.bands)]
+
+        checked = set()
+        for band, key in enumerate(keys):
+            candidates = self.buckets[band].get(key)
+            if candidates is None:
+                continue
+            for candidate in (candidates,) if isinstance(candidates, int) else candidates:
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                if self._similarity(shingles, candidate) >= self.threshold:
+                    self.dropped += 1
+                    return True
+
+        record_id = len(self.offsets) - 1
+        self.shingles.extend(shingles)
+        self.offsets.append(len(self.shingles))
+        for band, key in enumerate(keys):
+            bucket = self.buckets[band]
+            candidates = bucket.get(key)
+            if candidates is None:
+                bucket[key] = record_id
+            elif isinstance(candidates, int):
+                bucket[key] = [candidates, record_id]
+            elif len(candidates) < _BUCKET_CAPACITY:
+                candidates.append(record_id)
+        return False
+
+    def _similarity(self, shingles: set[int], record_id: int) -> float:
+        kept = self.shingles[self.offsets[record_id]:self.offsets[record_id + 1]]
+        common = len(shingles.intersection(kept))
+        return common / (len(shingles) + len(kept) - common)
+
+    def filter(self, records: Iterable[dict]) -> Iterator[dict]:
+        for record in records:
+            if not self.is_duplicate(self.text(record)):
+                yield record
+
+    def __repr__(self):
+        return f"{self.dropped:,} of {self.seen:,} records dropped as near duplicates (threshold {self.threshold}, {self.bands} bands x {self.rows} rows)"
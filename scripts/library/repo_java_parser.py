@@ -1,33 +1,83 @@
 # @author: stephen
 
+import os
 import re
 import json
+import hashlib
 from collections import defaultdict
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from sys import intern
 from typing import Dict, Optional
 from tqdm import tqdm
-from .java_parser import JavaParser, JavaParseResult, ClassParseResult, MethodParseResult, FieldParseResult, ImportParseResult
+from tree_sitter import Parser
+from . import ast_cache
+from .java_parser import LANGUAGE, JavaParser, JavaParseResult, ClassParseResult, MethodParseResult, FieldParseResult, ImportParseResult
+
+
+# one tree-sitter parser per worker process, created by _init_parse_worker
+_worker_parser: Optional[Parser] = None
+
+
+def _init_parse_worker() -> None:
+    global _worker_parser
+    _worker_parser = Parser(LANGUAGE)
+
+
+def _parse_java_files(paths: list[str]) -> list[JavaParseResult]:
+    return [JavaParser(path, parser=_worker_parser).result for path in paths]
+
+
+def _intern(value):
+    return intern(value) if isinstance(value, str) else value
+
+
+AST_CACHE_VERSION = 3
+AST_CACHE_FORMATS = ("json", "binary")
 
 
 class RepoJavaParser:
-    def __init__(self, repo_path: str, reparse: bool = False, output_path: str = None):
+    def __init__(self, repo_path: str, reparse: bool = False, output_path: str = None, workers: int = 1, incremental: bool = False,
+                 cache_format: str = "json"):
         """Initialize repository Java parser.
         
         Args:
             repo_path: Path to the repository
             reparse: Whether to force reparse all files
-            output_path: Path to save/load the AST JSON file
+            output_path: Path to save/load the AST cache file
+            workers: Number of processes used to parse Java files, 0 means one per CPU
+            incremental: Whether to reparse the files added, changed or deleted since the AST cache file was saved
+            cache_format: Format used to save the AST cache, "json" or "binary" (memory-mapped, loaded lazily per file),
+                          loading detects the format of the existing file
         """
         self.repo_path = Path(repo_path)
         if not self.repo_path.exists():
             raise ValueError(f"Repository path {repo_path} does not exist")
-            
-        self.output_path = output_path or str(self.repo_path / 'ast.json')
-        self.result: Dict[str, JavaParseResult] = {}
+        if cache_format not in AST_CACHE_FORMATS:
+            raise ValueError(f"Unsupported AST cache format {cache_format}, expected one of {AST_CACHE_FORMATS}")
+        if cache_format == "binary" and ast_cache.msgpack is None:
+            print("Warning: binary AST cache requires 'msgpack', falling back to json. To use it, please install it:")
+            print("pip install msgpack")
+            cache_format = "json"
+
+        self.cache_format = cache_format
+        self.output_path = output_path or str(self.repo_path / ('ast.bin' if cache_format == "binary" else 'ast.json'))
+        self.workers = workers if workers > 0 else os.cpu_count() or 1
+        self.result: MutableMapping[str, JavaParseResult] = {}
+        # path -> {"mtime", "size", "hash"} of the file content the parse result was built from
+        self.stats: Dict[str, dict] = {}
+        # (package, class name) -> path of the file declaring the class
+        self.class_index: Dict[tuple[str, str], str] = {}
+        # (package, class name) -> paths of the files referencing the class by explicit or implicit import
+        self.import_references: Dict[tuple[str, str], list[str]] = {}
+        self.implicit_import_references: Dict[tuple[str, str], list[str]] = {}
 
         self.apps = self._parse_all_apps(repo_path)
         if not reparse and Path(self.output_path).exists():
             self._load()
+            if incremental:
+                self._update()
         else:
             self._parse()
 
@@ -54,34 +104,50 @@ class RepoJavaParser:
         """Load parsed results from JSON file."""
         print(f"Loading parsed results from {self.output_path}...")
 
+        if ast_cache.is_binary_cache(self.output_path):
+            self._load_binary()
+            return
+
         with open(self.output_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
 
+        # ast.json saved before the cache was versioned only contains the files
+        references = None
+        if data.get("version") == AST_CACHE_VERSION:
+            self.stats = data["stats"]
+            references = data.get("references")
+            data = data["files"]
+        elif "version" in data:
+            print(f"AST cache {self.output_path} was saved by another version, reparsing...")
+            self._parse()
+            return
+
         print(f"Success loaded: {len(data)} files found")
 
         for path, file_data in data.items():
             result = JavaParseResult()
             result.path = path
-            result.root = file_data['root']
-            result.package = file_data['package']
-            result.implicit_imports = file_data.get('implicit_imports', [])
+            result.source_stat = self.stats.get(path)
+            result.root = _intern(file_data['root'])
+            result.package = _intern(file_data['package'])
+            result.implicit_imports = [_intern(i) for i in file_data.get('implicit_imports', [])]
 
             # Rebuild imports
             result.imports = []
             for import_data in file_data['imports']:
                 import_result = ImportParseResult()
-                import_result.package = import_data['package']
-                import_result.class_name = import_data['class_name']
+                import_result.package = _intern(import_data['package'])
+                import_result.class_name = _intern(import_data['class_name'])
                 result.imports.append(import_result)
             
             # Rebuild classes
             result.classes = []
             for class_data in file_data['classes']:
                 class_result = ClassParseResult()
-                class_result.name = class_data['name']
-                class_result.modifiers = class_data['modifiers']
+                class_result.name = _intern(class_data['name'])
+                class_result.modifiers = _intern(class_data['modifiers'])
                 class_result.type_parameters = class_data.get('type_parameters', [])
-                class_result.type = class_data['type']
+                class_result.type = _intern(class_data['type'])
                 class_result.interfaces = class_data.get('interfaces', [])
                 class_result.superclass = class_data.get('superclass', None)
 
@@ -90,8 +156,8 @@ class RepoJavaParser:
                 for field_data in class_data['fields']:
                     field_result = FieldParseResult()
                     field_result.declarator = field_data['declarator']
-                    field_result.type = field_data['type']
-                    field_result.modifiers = field_data['modifiers']
+                    field_result.type = _intern(field_data['type'])
+                    field_result.modifiers = _intern(field_data['modifiers'])
 
                     class_result.fields.append(field_result)
                 
@@ -101,27 +167,57 @@ class RepoJavaParser:
                     method_result = MethodParseResult()
                     method_result.name = method_name
                     method_result.parameters = method_data['parameters']
-                    method_result.type = method_data['type']
-                    method_result.modifiers = method_data['modifiers']
+                    method_result.type = _intern(method_data['type'])
+                    method_result.modifiers = _intern(method_data['modifiers'])
                     method_result.type_parameters = method_data.get('type_parameters', [])
                     method_result.throws = method_data.get('throws', [])
+                    method_result.start_byte = method_data.get('start_byte', 0)
+                    method_result.end_byte = method_data.get('end_byte', 0)
+                    method_result.body_start_byte = method_data.get('body_start_byte', 0)
+                    method_result.body_end_byte = method_data.get('body_end_byte', 0)
+                    body_references = method_data.get('body_references')
+                    method_result.body_references = None if body_references is None else [_intern(r) for r in body_references]
                     
                     class_result.methods[method_name] = method_result
                     
                 result.classes.append(class_result)
             
             self.result[path] = result
+
+        self._build_class_index()
+        if references:
+            self.import_references = self._decode_references(references["imports"])
+            self.implicit_import_references = self._decode_references(references["implicit_imports"])
+        else:
+            self._build_reference_index()
     
+    def _load_binary(self) -> None:
+        """Map the binary cache, file results are deserialized on first access."""
+        if ast_cache.msgpack is None:
+            raise ValueError(f"{self.output_path} is a binary AST cache, please install 'msgpack' to load it")
+        if ast_cache.read_binary_cache_version(self.output_path) != ast_cache.VERSION:
+            print(f"Binary AST cache {self.output_path} was saved by another version, reparsing...")
+            self._parse()
+            return
+
+        cache = ast_cache.load_binary_cache(self.output_path)
+        self.result = cache.results
+        self.stats = cache.stats
+        self.class_index = cache.class_index
+        self.import_references = cache.import_references
+        self.implicit_import_references = cache.implicit_import_references
+
+        print(f"Success loaded: {len(self.result)} files found")
+
     def _parse(self) -> None:
         """Parse all Java files in the repository."""
         print(f"Parsed ast not found, parsing Java files in {self.repo_path}...")
 
-        java_files = list(self.repo_path.rglob('*.java'))
+        java_files = [str(java_file) for java_file in self.repo_path.rglob('*.java')]
 
-        for java_file in tqdm(java_files, desc="Parsing Java files", unit="file"):
-            parser = JavaParser(str(java_file))
-            parser.parse(str(java_file))
-            self.result[str(java_file)] = parser.result
+        self.stats = {java_file: self._file_stat(java_file) for java_file in java_files}
+        for java_file, result in zip(java_files, self._parse_files(java_files)):
+            self.result[java_file] = result
 
         packages_map = defaultdict(list)
         for result in self.result.values():
@@ -133,19 +229,175 @@ class RepoJavaParser:
 
         self._filter_imports()
 
-        # Save results
+        self._build_indexes()
+        self._save()
+        print(f"Total {len(java_files)} Java files parsed and saved to {self.output_path}")
+
+    def _update(self) -> None:
+        """Reparse the files added, changed or deleted since the AST JSON file was saved."""
+        java_files = [str(java_file) for java_file in self.repo_path.rglob('*.java')]
+
+        deleted_files = self.result.keys() - set(java_files)
+        changed_files = []
+        stats_changed = bool(deleted_files)
+        for java_file in java_files:
+            stat = os.stat(java_file)
+            old_stat = self.stats.get(java_file)
+            if old_stat and old_stat["mtime"] == stat.st_mtime_ns and old_stat["size"] == stat.st_size:
+                continue
+            # mtime or size changed, the content hash decides whether the file needs to be reparsed
+            new_stat = self._file_stat(java_file)
+            self.stats[java_file] = new_stat
+            stats_changed = True
+            if not old_stat or old_stat["hash"] != new_stat["hash"] or java_file not in self.result:
+                changed_files.append(java_file)
+
+        if not changed_files and not deleted_files:
+            if stats_changed:
+                self._save()
+            print("Parsed ast is up to date")
+            return
+
+        print(f"Updating parsed ast: {len(changed_files)} added or changed, {len(deleted_files)} deleted")
+
+        old_packages = {result.package for result in self.result.values() if result.package}
+        touched_packages = {self.result[path].package for path in changed_files + list(deleted_files) if path in self.result}
+        old_classes = defaultdict(set)
+        for result in self.result.values():
+            old_classes[result.package].update(c.name for c in result.classes)
+
+        for path in deleted_files:
+            del self.result[path]
+            self.stats.pop(path, None)
+        for path, result in zip(changed_files, self._parse_files(changed_files)):
+            self.result[path] = result
+            touched_packages.add(result.package)
+        touched_packages.discard("")
+
+        packages_map = defaultdict(list)
+        for path, result in self.result.items():
+            if result.package in touched_packages:
+                packages_map[result.package].append(path)
+
+        # implicit imports of unchanged files were filtered by the old classes of the package,
+        # they must be reparsed if the package gained classes or no longer has siblings to filter by
+        reparsed_files = set(changed_files)
+        stale_files = []
+        for package, paths in packages_map.items():
+            classes = {c.name for path in paths for c in self.result[path].classes}
+            if classes - old_classes[package] or len(paths) < 2:
+                stale_files.extend(path for path in paths if path not in reparsed_files)
+        for path, result in zip(stale_files, self._parse_files(stale_files)):
+            self.result[path] = result
+        reparsed_files.update(stale_files)
+
+        # unchanged files importing a class of a new package had the import dropped as outside the repo,
+        # they are reparsed to get it back, and filtered again like in a full parse
+        packages = {result.package for result in self.result.values() if result.package}
+        if packages - old_packages:
+            unchanged_files = [path for path in self.result if path not in reparsed_files]
+            for path, result in zip(unchanged_files, self._parse_files(unchanged_files)):
+                self.result[path] = result
+            reparsed_files.update(unchanged_files)
+            packages_map = defaultdict(list)
+            for path, result in self.result.items():
+                if result.package:
+                    packages_map[result.package].append(path)
+
+        for paths in packages_map.values():
+            self._filter_implicit_imports([self.result[path] for path in paths])
+
+        # only reparsed files still hold imports of packages outside the repo, unless a package is gone
+        if old_packages - packages:
+            self._filter_imports()
+        else:
+            self._filter_imports([self.result[path] for path in reparsed_files])
+
+        self._build_indexes()
+        self._save()
+        print(f"Total {len(reparsed_files)} Java files reparsed and saved to {self.output_path}")
+
+    def _save(self) -> None:
+        if self.cache_format == "binary":
+            ast_cache.save_binary_cache(self.output_path, self.result, self.stats, self.class_index,
+                                        self.import_references, self.implicit_import_references)
+            return
+
         with open(self.output_path, 'w', encoding='utf-8') as fd:
+            references = {"imports": self._encode_references(self.import_references),
+                          "implicit_imports": self._encode_references(self.implicit_import_references)}
+            data = {"version": AST_CACHE_VERSION, "stats": self.stats, "references": references, "files": dict(self.result)}
             # noinspection PyTypeChecker
-            json.dump(self.result, fd, indent=2, ensure_ascii=False, default=lambda o: {
-                k: v for k, v in o.__dict__.items() if not k.startswith('_') and k != 'node'
-            })
-        
-        print(f"Total {len(java_files)} Java files parsed and saved to {self.output_path}")
+            json.dump(data, fd, indent=2, ensure_ascii=False, default=lambda o: o.to_dict())
 
+    # noinspection PyMethodMayBeStatic
+    def _file_stat(self, path: str) -> dict:
+        with open(path, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        stat = os.stat(path)
+        return {"mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": content_hash}
+
+    def _parse_files(self, java_files: list[str]) -> list[JavaParseResult]:
+        if not java_files:
+            return []
+        if self.workers > 1:
+            return self._parse_files_in_parallel(java_files)
+        parser = Parser(LANGUAGE)
+        return [JavaParser(java_file, parser=parser).result
+                for java_file in tqdm(java_files, desc="Parsing Java files", unit="file")]
+
+    def _parse_files_in_parallel(self, java_files: list[str]) -> list[JavaParseResult]:
+        """Parse files in a process pool, results keep the order of java_files."""
+        # several chunks per worker to balance uneven file sizes, but big enough to amortize the IPC cost
+        chunk_size = max(1, min(64, len(java_files) // (self.workers * 4)))
+        chunks = [java_files[i:i + chunk_size] for i in range(0, len(java_files), chunk_size)]
+
+        results = []
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_parse_worker) as executor, \
+                tqdm(total=len(java_files), desc=f"Parsing Java files ({self.workers} workers)", unit="file") as pbar:
+            for chunk_results in executor.map(_parse_java_files, chunks):
+                results.extend(chunk_results)
+                pbar.update(len(chunk_results))
+        return results
+
+    def _build_indexes(self) -> None:
+        """Build lookup indexes over self.result, must be rebuilt whenever self.result changes."""
+        self._build_class_index()
+        self._build_reference_index()
+
+    def _build_class_index(self) -> None:
+        self.class_index = {}
+        for path, result in self.result.items():
+            for c in result.classes:
+                # keep the first file declaring the class, same as a linear scan
+                self.class_index.setdefault((result.package, c.name), path)
+
+    def _build_reference_index(self) -> None:
+        self.import_references = defaultdict(list)
+        self.implicit_import_references = defaultdict(list)
+        for path, result in self.result.items():
+            for key in dict.fromkeys((i.package, i.class_name) for i in result.imports):
+                self.import_references[key].append(path)
+            for key in dict.fromkeys((result.package, i) for i in result.implicit_imports):
+                self.implicit_import_references[key].append(path)
+        self.import_references = dict(self.import_references)
+        self.implicit_import_references = dict(self.implicit_import_references)
+
+    # noinspection PyMethodMayBeStatic
+    def _encode_references(self, references: Dict[tuple[str, str], list[str]]) -> dict:
+        encoded = defaultdict(dict)
+        for (package, class_name), paths in references.items():
+            encoded[package][class_name] = paths
+        return encoded
 
-    def _filter_imports(self) -> None:
+    # noinspection PyMethodMayBeStatic
+    def _decode_references(self, encoded: dict) -> Dict[tuple[str, str], list[str]]:
+        return {(package, class_name): paths
+                for package, classes in encoded.items() for class_name, paths in classes.items()}
+
+    def _filter_imports(self, results: list[JavaParseResult] = None) -> None:
         packages = {j.package for j in self.result.values() if j.package}
-        for result in self.result.values():
+        for result in self.result.values() if results is None else results:
             result.imports = [imp for imp in result.imports if imp.package in packages or imp.package.startswith("core.framework")]
 
 
@@ -161,11 +413,8 @@ class RepoJavaParser:
             rst.implicit_imports = [i for i in rst.implicit_imports if i in classes and i not in [c.name for c in rst.classes]]
 
     def find(self, package: str, class_name: str) -> Optional[JavaParseResult]:
-        for result in self.result.values():
-            if result.package == package and class_name in [c.name for c in result.classes]:
-                return result
-
-        return None
+        path = self.class_index.get((package, class_name))
+        return self.result[path] if path else None
 
     def find_app_or_module_of_class(self, package: str, class_name: str) -> Optional[JavaParseResult]:
         apps = self.find_references("core.framework.module", "App")
@@ -191,21 +440,10 @@ class RepoJavaParser:
         return self.find(imp.package, imp.class_name) if imp else None
 
     def _find_references_by_imports(self, package: str, class_name: str) -> list[JavaParseResult]:
-        references = []
-        for result in self.result.values():
-            for i in result.imports:
-                if i.package == package and i.class_name == class_name:
-                    references.append(result)
-                    break
-        return references
+        return [self.result[path] for path in self.import_references.get((package, class_name), [])]
 
     def _find_references_by_implicit_imports(self, package: str, class_name: str) -> list[JavaParseResult]:
-        references = []
-        for result in self.result.values():
-            if result.package == package:
-                if class_name in result.implicit_imports:
-                    references.append(result)
-        return references
+        return [self.result[path] for path in self.implicit_import_references.get((package, class_name), [])]
 
     def find_references(self, package: str, class_name: str) -> list[JavaParseResult]:
         return (self._find_references_by_imports(package, class_name) +
@@ -0,0 +1,59 @@
+# @author: stephen
+
+import json
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+
+class TraceSnapshotStore:
+    """
+    Local snapshots of action traces in a SQLite file, the documents of each action are stored as compressed JSON.
+
+    ActionTraces of an action with a snapshot younger than ttl_hours are loaded from it instead of Elasticsearch,
+    so reruns take milliseconds per trace, are reproducible and work offline. ttl_hours 0 keeps snapshots forever.
+    """
+
+    def __init__(self, path: str = "trace-snapshots.sqlite", ttl_hours: float = 168):
+        self.path = path
+        self.ttl = ttl_hours * 3600
+        self.hits = 0
+        self.misses = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS traces (
+                action TEXT PRIMARY KEY,
+                docs BLOB NOT NULL,
+                fetched_at REAL NOT NULL
+            )""")
+        if self.ttl:
+            self.db.execute("DELETE FROM traces WHERE fetched_at < ?", (time.time() - self.ttl,))
+        self.db.commit()
+
+    def get(self, action: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        The source documents of the trace of the action, None if there is no snapshot or it expired.
+        """
+        row = self.db.execute("SELECT docs, fetched_at FROM traces WHERE action = ?", (action,)).fetchone()
+        if row is None or (self.ttl and row[1] < time.time() - self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, action: str, docs: List[Dict[str, Any]]) -> None:
+        """
+        Saves the source documents of the trace of the action, an empty trace is not saved so it is fetched again next time.
+        """
+        if not docs:
+            return
+        value = zlib.compress(json.dumps(docs, ensure_ascii=False).encode("utf-8"))
+        self.db.execute("INSERT OR REPLACE INTO traces (action, docs, fetched_at) VALUES (?, ?, ?)", (action, value, time.time()))
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __repr__(self) -> str:
+        return f"{self.hits} traces loaded from {self.path}, {self.misses} fetched"
@@ -1,14 +1,20 @@
 # @author: stephen
 
 import fire
+import asyncio
 import litellm
 import json
 import os
+import random
 import textwrap
+import time
 from pathlib import Path
 from typing import Optional
-from token_cost_counter import count_cost
+from token_cost_counter import pack_by_token_budget, record_usage, TokenBudgetStats, UsageLedger
+from library.java_parser import JavaParseResult
 from library.repo_java_parser import RepoJavaParser
+from library.llm_cache import LLMResponseCache, cached_completion, acached_completion, json_content, is_json_response
+from library.jsonl_utils import is_json_array, read_records, append_records, write_records, load_processed_keys
 
 
 LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE = textwrap.dedent("""
@@ -60,8 +66,10 @@ You MUST provide the output in a single, valid JSON block. The root element must
 """)
 
 LITELLM_MODEL = "azure/gpt-4o"
+CONTEXT_TOKEN_BUDGET = 16000
 
-def generate_qa_pairs(target_file_name: str, target_file_content: str, pruned_context_bundle: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE) -> Optional[str]:
+def generate_qa_pairs(target_file_name: str, target_file_content: str, pruned_context_bundle: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE,
+                      cache: Optional[LLMResponseCache] = None, ledger: Optional[UsageLedger] = None) -> Optional[str]:
     """
     Generates Q&A pairs for a target file using an LLM.
 
@@ -70,6 +78,8 @@ def generate_qa_pairs(target_file_name: str, target_file_content: str, pruned_co
         target_file_content: The full source code of the target file.
         pruned_context_bundle: A string containing the source code of dependency files.
         prompt_template: The template used to format the prompt for the LLM.
+        cache: The LLM response cache, None always calls the LLM.
+        ledger: Records the usage of the LLM request.
 
     Returns:
         A string containing a JSON array of Q&A pairs, or None if an error occurs.
@@ -82,85 +92,173 @@ def generate_qa_pairs(target_file_name: str, target_file_content: str, pruned_co
     )
 
     try:
-        response = litellm.completion(
+        start = time.perf_counter()
+        response = cached_completion(
+            cache,
             model=LITELLM_MODEL,
             messages=[{"role": "user", "content": prompt}],
+            validate=is_json_response,
             temperature=0.1,  # Lower temperature for more factual, less creative output
         )
+        record_usage(response, LITELLM_MODEL, time.perf_counter() - start, ledger, label=target_file_name)
+        return parse_qa_response(response)
+    except Exception as e:
+        print(f"    !! ERROR: An exception occurred during the litellm API call: {e}")
+        return None
+
+
+async def agenerate_qa_pairs(target_file_name: str, target_file_content: str, pruned_context_bundle: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE,
+                             retries: int = 3, backoff: float = 2.0, cache: Optional[LLMResponseCache] = None,
+                             ledger: Optional[UsageLedger] = None) -> Optional[str]:
+    """
+    Async version of generate_qa_pairs, the litellm call is retried with exponential backoff and jitter.
+
+    Args:
+        target_file_name: The name of the file to generate Q&A for.
+        target_file_content: The full source code of the target file.
+        pruned_context_bundle: A string containing the source code of dependency files.
+        prompt_template: The template used to format the prompt for the LLM.
+        retries: How many times a failed litellm call is retried.
+        backoff: Delay in seconds before the first retry, doubled for each following retry.
+        cache: The LLM response cache, None always calls the LLM.
+        ledger: Records the usage of the LLM request, the latency includes the retries.
+
+    Returns:
+        A string containing a JSON array of Q&A pairs, or None if an error occurs.
+    """
+    print(f"  - Generating Q&A for {Path(target_file_name).name} with model: {LITELLM_MODEL}")
+    prompt = prompt_template.format(
+        PRUNED_CONTEXT_BUNDLE=pruned_context_bundle,
+        TARGET_FILE_NAME=target_file_name,
+        TARGET_FILE_CONTENT=target_file_content,
+    )
 
-        # Extract the text content from the response
-        content = response.choices[0].message.content
-
-        # Clean the response: LLMs sometimes wrap JSON in markdown fences (```json ... ```)
-        if content.strip().startswith("```json"):
-            content = content.strip()[7:-3].strip()
-        elif content.strip().startswith("```"):
-            content = content.strip()[3:-3].strip()
-
-        usage = response.get("usage")
-        completion_tokens = usage.get("completion_tokens", 0)
-        completion_cost = count_cost(completion_tokens, model=LITELLM_MODEL, token_type="input_cost_per_token")
-        prompt_tokens = usage.get("prompt_tokens", 0)
-        prompt_cost = count_cost(completion_tokens, model=LITELLM_MODEL, token_type="output_cost_per_token")
-        total_tokens = usage.get("total_tokens", 0)
-        total_cost = completion_cost + prompt_cost
-        print(f"  - Usage: {completion_tokens} completion tokens - cost: {completion_cost}, {prompt_tokens} prompt tokens - cost: {prompt_cost}, {total_tokens} total tokens - cost: {total_cost}")
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            response = await acached_completion(
+                cache,
+                model=LITELLM_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                validate=is_json_response,
+                temperature=0.1,  # Lower temperature for more factual, less creative output
+            )
+            break
+        except Exception as e:
+            if attempt == retries:
+                print(f"    !! ERROR: An exception occurred during the litellm API call: {e}")
+                return None
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+            print(f"    !! WARN: litellm API call failed ({e}), retry {attempt + 1}/{retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    try:
+        record_usage(response, LITELLM_MODEL, time.perf_counter() - start, ledger, label=target_file_name)
+        return parse_qa_response(response)
+    except Exception as e:
+        print(f"    !! ERROR: An exception occurred while reading the litellm response: {e}")
+        return None
+
+
+def parse_qa_response(response) -> Optional[str]:
+    """
+    Extracts the JSON array of Q&A pairs from a litellm response.
+
+    Returns:
+        A string containing a JSON array of Q&A pairs, or None if the LLM returned invalid JSON.
+    """
+    # Extract the text content from the response, without markdown fences
+    content = json_content(response)
+
+    try:
         # Validate that the content is valid JSON
         json.loads(content)
         return content
-
     except json.JSONDecodeError as e:
         print(f"    !! ERROR: LLM returned invalid JSON. {e}")
         print(f"    -- Raw Response --\n{content}\n--------------------")
         return None
-    except Exception as e:
-        print(f"    !! ERROR: An exception occurred during the litellm API call: {e}")
-        return None
 
 
-def build_pruned_context_bundle(repo_parser: RepoJavaParser, target_file_path: str) -> str:
+def build_pruned_context_bundle(repo_parser: RepoJavaParser, target_file_path: str, token_budget: int = CONTEXT_TOKEN_BUDGET,
+                                stats: Optional[TokenBudgetStats] = None) -> str:
     """
-    Build a pruned context bundle by calling an external Java parser script.
+    Build a pruned context bundle of the files related to the target file, packed in a token budget.
 
-    This function executes `repo_java_parser.py resolve` to perform static
-    analysis on the target Java file and get its relevant dependencies.
+    Candidates are ranked by relevance: classes imported by the target file, then classes of its package
+    used without import, then files referencing the target class. Every packed candidate is rendered with
+    its class and method signatures, and upgraded to the whole file while the budget allows.
 
     Args:
         repo_parser: The repository parser object.
         target_file_path: The absolute path to the target .java file.
+        token_budget: Maximum number of tokens of the bundle.
+        stats: Accumulates the included and dropped tokens.
 
     Returns:
-        A single string containing the concatenated context from the parser,
-        or an empty string if an error occurs.
+        A single string containing the concatenated context of the related files,
+        or an empty string if the target file is not parsed.
     """
-    refers = repo_parser.find_references(target_file_path)
-    return "\n\n".join([str(refer) for refer in refers])
+    target = repo_parser.result.get(target_file_path)
+    if target is None:
+        return ""
+
+    related = []
+    seen = {target_file_path}
+
+    def add(rst: Optional[JavaParseResult]) -> None:
+        if rst and rst.path not in seen:
+            seen.add(rst.path)
+            related.append(rst)
+
+    for imp in target.imports:
+        add(repo_parser.find(imp.package, imp.class_name))
+    for class_name in target.implicit_imports:
+        add(repo_parser.find(target.package, class_name))
+    for refer in repo_parser.find_references(target.package, target.root):
+        add(refer)
+
+    candidates = []
+    for rst in related:
+        renderings = [f"// {rst.path}\n{rst}"]
+        try:
+            renderings.append(f"// {rst.path}\n" + Path(rst.path).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            print(f"!! ERROR: File {rst.path} not found in the repository.")
+        candidates.append(renderings)
+    return "\n\n".join(pack_by_token_budget(candidates, token_budget, model=LITELLM_MODEL, stats=stats))
 
 
-def file2qa(repo_parser: RepoJavaParser, target_file_path: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE, rst_path: str = "library-source-code-to-qa.jsonl") -> None:
+def file2qa(repo_parser: RepoJavaParser, target_file_path: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE, rst_path: str = "library-source-code-to-qa.jsonl",
+            processed_files: Optional[set[str]] = None, cache: Optional[LLMResponseCache] = None,
+            context_token_budget: int = CONTEXT_TOKEN_BUDGET, context_stats: Optional[TokenBudgetStats] = None,
+            ledger: Optional[UsageLedger] = None) -> None:
     """
     Orchestrates the Q&A generation process for a single Java file.
-    It builds the context, generates the Q&A, and saves it to a .json file.
+    It builds the context, generates the Q&A, and appends it to a .jsonl file.
 
     Args:
         repo_parser: The repository parser object that contains the parsed Java files.
         target_file_path: The absolute path to the target .java file.
-        rst_path: The path where the generated Q&A will be saved as a JSON file.
+        rst_path: The path where the generated Q&A will be appended as JSON lines.
         prompt_template: The template used to format the prompt for the LLM.
+        processed_files: The filepaths already in rst_path, loaded from rst_path if not given.
+        cache: The LLM response cache, None always calls the LLM.
+        context_token_budget: Maximum number of tokens of the context bundle.
+        context_stats: Accumulates the tokens included in and dropped from the context bundles.
+        ledger: Records the usage of the LLM requests and the processed files.
     """
     target_path_obj = Path(target_file_path)
     output_path = Path(rst_path)
 
     # Check if the file has already been processed
-    if os.path.exists(output_path):
-        with open(output_path, 'r', encoding="utf-8") as f:
-            existing_data = json.load(f)
-        processed_files = {entry.get("filename") for entry in existing_data}
-        if target_path_obj.name in processed_files:
-            print(f"  - SKIPPED: {target_path_obj.name} is already processed.")
-            return
-    else:
-        existing_data = []
+    if processed_files is None:
+        processed_files = load_processed_files(output_path)
+    if target_file_path in processed_files:
+        print(f"  - SKIPPED: {target_path_obj.name} is already processed.")
+        return
+    if ledger:
+        ledger.count_file()
 
     try:
         # 1. Read the target file content
@@ -168,33 +266,20 @@ def file2qa(repo_parser: RepoJavaParser, target_file_path: str, prompt_template:
 
         # 2. Build the context bundle from sibling files
         print("  - Building context bundle...")
-        pruned_context_bundle = build_pruned_context_bundle(repo_parser, target_file_path)
+        pruned_context_bundle = build_pruned_context_bundle(repo_parser, target_file_path, context_token_budget, context_stats)
 
         # 3. Generate Q&A pairs
         qa_json_str = generate_qa_pairs(
             target_file_name=target_file_path,
             target_file_content=target_file_content,
             pruned_context_bundle=pruned_context_bundle,
-            prompt_template=prompt_template
+            prompt_template=prompt_template,
+            cache=cache,
+            ledger=ledger
         )
 
         # 4. Save the result to a file
-        if qa_json_str:
-            new_data = json.loads(qa_json_str)
-
-            # Add filepath field to each entry
-            for entry in new_data:
-                entry["filepath"] = target_file_path
-
-            # Append new Q&A pairs to the existing data
-            existing_data.extend(new_data)
-
-            # Write the updated data back to the file
-            with open(output_path, 'w', encoding="utf-8") as f:
-                json.dump(existing_data, f, ensure_ascii=False, indent=2)
-            print(f"  - SUCCESS: Saved Q&A to {output_path.name}")
-        else:
-            print("  - FAILED: No Q&A data was generated.")
+        save_qa_pairs(output_path, processed_files, target_file_path, qa_json_str)
 
     except FileNotFoundError:
         print(f"!! ERROR: Target file not found at {target_file_path}")
@@ -202,7 +287,97 @@ def file2qa(repo_parser: RepoJavaParser, target_file_path: str, prompt_template:
         print(f"!! ERROR: An unexpected error occurred while processing {target_path_obj.name}: {e}")
 
 
-def enhance_repo_file_qa(repo_path: str, target_file_path: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE, rst_path: str = "library-source-code-to-qa.jsonl") -> None:
+def load_processed_files(output_path: Path) -> set[str]:
+    if os.path.exists(output_path) and is_json_array(output_path):
+        raise ValueError(f"{output_path} is a JSON array, convert it to JSONL first: python tools.py to_jsonl {output_path}")
+    return load_processed_keys(output_path, lambda entry: entry.get("filepath"))
+
+
+def save_qa_pairs(output_path: Path, processed_files: set[str], target_file_path: str, qa_json_str: Optional[str]) -> None:
+    if qa_json_str:
+        new_data = json.loads(qa_json_str)
+
+        # Add filepath field to each entry
+        for entry in new_data:
+            entry["filepath"] = target_file_path
+
+        # Append new Q&A pairs to the file
+        append_records(output_path, new_data)
+        processed_files.add(target_file_path)
+        print(f"  - SUCCESS: Saved Q&A of {Path(target_file_path).name} to {output_path.name}")
+    else:
+        print(f"  - FAILED: No Q&A data was generated for {Path(target_file_path).name}.")
+
+
+async def afile2qa(repo_parser: RepoJavaParser, target_file_path: str, prompt_template: str, semaphore: asyncio.Semaphore, retries: int,
+                  cache: Optional[LLMResponseCache] = None, context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+                  context_stats: Optional[TokenBudgetStats] = None, ledger: Optional[UsageLedger] = None) -> Optional[str]:
+    """
+    Builds the context and generates the Q&A of a single Java file, at most `semaphore` files are in flight at once.
+
+    Returns:
+        A string containing a JSON array of Q&A pairs, or None if an error occurs.
+    """
+    async with semaphore:
+        try:
+            target_file_content = Path(target_file_path).read_text(encoding="utf-8")
+            pruned_context_bundle = build_pruned_context_bundle(repo_parser, target_file_path, context_token_budget, context_stats)
+            return await agenerate_qa_pairs(
+                target_file_name=target_file_path,
+                target_file_content=target_file_content,
+                pruned_context_bundle=pruned_context_bundle,
+                prompt_template=prompt_template,
+                retries=retries,
+                cache=cache,
+                ledger=ledger
+            )
+        except FileNotFoundError:
+            print(f"!! ERROR: Target file not found at {target_file_path}")
+        except Exception as e:
+            print(f"!! ERROR: An unexpected error occurred while processing {Path(target_file_path).name}: {e}")
+        return None
+
+
+async def arepo2qa(repo_parser: RepoJavaParser, prompt_template: str, rst_path: str, processed_files: set[str], concurrency: int, retries: int,
+                   cache: Optional[LLMResponseCache] = None, context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+                   context_stats: Optional[TokenBudgetStats] = None, ledger: Optional[UsageLedger] = None) -> None:
+    """
+    Generates the Q&A of all files of the repository with up to `concurrency` concurrent LLM calls.
+    Results are saved by this coroutine alone, in the order of the files, so the output is the same as a serial run.
+    """
+    output_path = Path(rst_path)
+
+    file_paths = []
+    for file_path in repo_parser.result:
+        if file_path in processed_files:
+            print(f"  - SKIPPED: {Path(file_path).name} is already processed.")
+        else:
+            file_paths.append(file_path)
+    print(f"Processing {len(file_paths)} files with concurrency {concurrency}.\n")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [asyncio.create_task(afile2qa(repo_parser, file_path, prompt_template, semaphore, retries, cache,
+                                                   context_token_budget, context_stats, ledger)) for file_path in file_paths]
+    failed = 0
+    for i, (file_path, task) in enumerate(zip(file_paths, tasks)):
+        qa_json_str = await task
+        if ledger:
+            ledger.count_file()
+        print(f"[{i + 1}/{len(file_paths)}] Processed: {Path(file_path).relative_to(repo_parser.repo_path)}")
+        # a response that is not a JSON array of Q&A pairs fails this file only, like in file2qa
+        try:
+            save_qa_pairs(output_path, processed_files, file_path, qa_json_str)
+        except Exception as e:
+            print(f"!! ERROR: An unexpected error occurred while saving the Q&A of {Path(file_path).name}: {e}")
+            qa_json_str = None
+        if not qa_json_str:
+            failed += 1
+    print(f"{len(file_paths) - failed} of {len(file_paths)} files saved, {failed} failed.")
+
+
+def enhance_repo_file_qa(repo_path: str, target_file_path: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE, rst_path: str = "library-source-code-to-qa.jsonl",
+                         no_cache: bool = False, cache_path: str = "llm-cache.sqlite", context_token_budget: int = CONTEXT_TOKEN_BUDGET,
+                         ledger_path: str = "usage-ledger.jsonl") -> None:
     """
     Enhances the Q&A generation for a specific file in a repository. 
     The rst_path already have the Q&A pairs of this file, this method will generate more Q&A pairs for this file.
@@ -213,18 +388,22 @@ def enhance_repo_file_qa(repo_path: str, target_file_path: str, prompt_template:
     :param target_file_path: The absolute path to the target .java file.
     :param prompt_template: The template used to format the prompt for the LLM.
     :param rst_path: The path where the generated Q&A will be saved as a JSON file.
+    :param no_cache: Always call the LLM, without reading or writing the LLM response cache.
+    :param cache_path: The SQLite file of the LLM response cache.
+    :param context_token_budget: Maximum number of tokens of the context bundle.
+    :param ledger_path: JSONL file the usage of the LLM request and of the run is appended to.
     :return: save the enhanced Q&A pairs to a JSON file.
     """
     repo_parser = RepoJavaParser(repo_path)
+    cache = None if no_cache else LLMResponseCache(cache_path)
+    ledger = UsageLedger(ledger_path, LITELLM_MODEL, command="enhance_repo_file_qa", context_token_budget=context_token_budget)
     target_path_obj = Path(target_file_path)
     output_path = Path(rst_path)
 
     try:
+        ledger.count_file()
         # 1. Read existing Q&A pairs
-        existing_data = []
-        if os.path.exists(output_path):
-            with open(output_path, 'r', encoding="utf-8") as f:
-                existing_data = json.load(f)
+        existing_data = list(read_records(output_path)) if os.path.exists(output_path) else []
 
         # Find existing Q&A pairs for the target file
         target_qa_pairs = [entry for entry in existing_data if entry.get("filepath") == target_file_path]
@@ -233,7 +412,7 @@ def enhance_repo_file_qa(repo_path: str, target_file_path: str, prompt_template:
 
         # 3. Build the context bundle from sibling files
         print("  - Building context bundle...")
-        pruned_context_bundle = build_pruned_context_bundle(repo_parser, target_file_path)
+        pruned_context_bundle = build_pruned_context_bundle(repo_parser, target_file_path, context_token_budget)
 
         # 4. Add existing Q&A pairs to the prompt template
         if target_qa_pairs:
@@ -247,7 +426,9 @@ def enhance_repo_file_qa(repo_path: str, target_file_path: str, prompt_template:
             target_file_name=target_file_path,
             target_file_content=target_file_content,
             pruned_context_bundle=pruned_context_bundle,
-            prompt_template=prompt_template
+            prompt_template=prompt_template,
+            cache=cache,
+            ledger=ledger
         )
 
         # 6. Save the result to a file
@@ -265,8 +446,7 @@ def enhance_repo_file_qa(repo_path: str, target_file_path: str, prompt_template:
             combined_data.sort(key=lambda x: x["filepath"])
 
             # Write the updated data back to the file
-            with open(output_path, 'w', encoding="utf-8") as f:
-                json.dump(combined_data, f, ensure_ascii=False, indent=2)
+            write_records(output_path, combined_data)
             print(f"  - SUCCESS: Enhanced Q&A saved to {output_path.name}")
         else:
             print("  - FAILED: No enhanced Q&A data was generated.")
@@ -275,11 +455,22 @@ def enhance_repo_file_qa(repo_path: str, target_file_path: str, prompt_template:
         print(f"!! ERROR: Target file not found at {target_file_path}")
     except Exception as e:
         print(f"!! ERROR: An unexpected error occurred while processing {target_path_obj.name}: {e}")
+    finally:
+        ledger.close()
 
 
-def repo2qa(repo_path: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE, rst_path ="library-source-code-to-qa.jsonl") -> None:
+def repo2qa(repo_path: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PROMPT_TEMPLATE, rst_path ="library-source-code-to-qa.jsonl",
+            concurrency: int = 1, retries: int = 3, no_cache: bool = False, cache_path: str = "llm-cache.sqlite",
+            context_token_budget: int = CONTEXT_TOKEN_BUDGET, ledger_path: str = "usage-ledger.jsonl") -> None:
     """
     Traverses a repository, finds all .java files, and generates Q&A pairs for each.
+
+    :param concurrency: Number of files processed concurrently with litellm.acompletion, 1 processes files one by one.
+    :param retries: How many times a failed litellm call is retried in concurrent mode.
+    :param no_cache: Always call the LLM, without reading or writing the LLM response cache.
+    :param cache_path: The SQLite file of the LLM response cache, responses of identical prompts are reused from it.
+    :param context_token_budget: Maximum number of tokens of the context bundle of each file.
+    :param ledger_path: JSONL file the usage of every LLM request and of the run is appended to.
     """
     print(f"Starting Q&A generation for repository: {repo_path}")
     print("=" * 60)
@@ -290,18 +481,31 @@ def repo2qa(repo_path: str, prompt_template: str = LIBRARY_SOURCE_CODE_TO_QA_PRO
 
     print(f"Found {total_files} .java files to process.\n")
 
-    for i, file_path in enumerate(repo_parser.result):
-        file_path_obj = Path(file_path)
-        relative_path = file_path_obj.relative_to(repo_path_obj)
-        print(f"[{i + 1}/{total_files}] Processing: {relative_path}")
-        try:
-            file2qa(repo_parser, file_path, prompt_template, rst_path)
-        except Exception as e:
-            print(f"  !! FATAL ERROR in file2qa for {relative_path}: {e}")
-        print("-" * 40)
+    processed_files = load_processed_files(Path(rst_path))
+    cache = None if no_cache else LLMResponseCache(cache_path)
+    context_stats = TokenBudgetStats()
+    ledger = UsageLedger(ledger_path, LITELLM_MODEL, command="repo2qa", concurrency=concurrency, context_token_budget=context_token_budget)
+
+    if concurrency > 1:
+        asyncio.run(arepo2qa(repo_parser, prompt_template, rst_path, processed_files, concurrency, retries, cache,
+                             context_token_budget, context_stats, ledger))
+    else:
+        for i, file_path in enumerate(repo_parser.result):
+            file_path_obj = Path(file_path)
+            relative_path = file_path_obj.relative_to(repo_path_obj)
+            print(f"[{i + 1}/{total_files}] Processing: {relative_path}")
+            try:
+                file2qa(repo_parser, file_path, prompt_template, rst_path, processed_files, cache, context_token_budget, context_stats, ledger)
+            except Exception as e:
+                print(f"  !! FATAL ERROR in file2qa for {relative_path}: {e}")
+            print("-" * 40)
 
     print("\n" + "=" * 60)
     print("Repository processing complete.")
+    print(f"Context bundles: {context_stats}")
+    ledger.close()
+    if cache:
+        print(f"LLM response cache: {cache.hits} hits, {cache.misses} misses")
 
 
 if __name__ == "__main__":
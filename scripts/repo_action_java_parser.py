@@ -1,8 +1,9 @@
 # @author: stephen
 
 import fire
-from library.action_trace import ActionTraces, ActionDocument, RecentActions
+from library.action_trace import ActionTraces, ActionDocument, RecentActions, fetch_action_traces
 from library.repo_java_parser import RepoJavaParser
+from library.trace_store import TraceSnapshotStore
 
 
 def fetch_api_context(doc: ActionDocument, parser: RepoJavaParser, debug: bool = False) -> list[str]:
@@ -73,8 +74,9 @@ def fetch_handler_context(doc: ActionDocument, parser: RepoJavaParser, debug: bo
     return [impl.path] + [parser.find(f.package, f.class_name).path for f in references] + [f.path for f in impl_references]
 
 
-def fetch_action_context(action: str, parser: RepoJavaParser, level: int = 3, seen: set[str] = None, debug: bool = False) -> list[str]:
-    trace = ActionTraces(action)
+def fetch_action_context(action: str, parser: RepoJavaParser, level: int = 3, seen: set[str] = None, debug: bool = False, trace: ActionTraces = None) -> list[str]:
+    if trace is None:
+        trace = ActionTraces(action)
     if trace.get_root_doc().app not in parser.apps:
         print(f"Action {action} does not belong to any of the specified apps in the repo: {parser.apps}")
         return []
@@ -98,20 +100,22 @@ def fetch_action_context(action: str, parser: RepoJavaParser, level: int = 3, se
     return files
 
 
-def build_repo_action_context(parser: RepoJavaParser):
+def build_repo_action_context(parser: RepoJavaParser, store: TraceSnapshotStore = None):
     print(f"Building action context for repository: {parser.repo_path}")
     actions = RecentActions(10, path="recent_actions.json")
+    traces = fetch_action_traces([action.action for action in actions.actions], store=store)
     seen = set()
     for action in actions.actions:
-        fetch_action_context(action.action, parser, seen=seen)
+        fetch_action_context(action.action, parser, seen=seen, trace=traces[action.action])
 
 
-def main(repo_path: str, action: str = None):
+def main(repo_path: str, action: str = None, trace_store_path: str = "trace-snapshots.sqlite", trace_ttl_hours: float = 168):
     parser = RepoJavaParser(repo_path)
+    store = TraceSnapshotStore(trace_store_path, trace_ttl_hours) if trace_store_path else None
     if action:
-        fetch_action_context(action, parser)
+        fetch_action_context(action, parser, trace=ActionTraces(action, store=store))
     else:
-        build_repo_action_context(parser)
+        build_repo_action_context(parser, store)
 
 if __name__ == '__main__':
     fire.Fire(main)
\ No newline at end of file
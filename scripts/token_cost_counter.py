@@ -1,31 +1,275 @@
 import os
 import fire
+import hashlib
+import json
 import litellm
+import time
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-from typing import Tuple
+from typing import Optional, Tuple
 from library.git_ignore import GitignoreMatcher
+from library.jsonl_utils import append_records
 
 # Suppress litellm's informational messages for a cleaner output
 litellm.suppress_prompt_logging = True
 
 def count_cost(total_tokens: int, model: str = "gpt-4o", token_type: str = "input_cost_per_token") -> float:
+    """
+    Cost of tokens of a model, token_type is "input_cost_per_token" for prompt tokens or "output_cost_per_token"
+    for completion tokens. Returns 0.0 if the model is not in litellm's pricing data.
+    """
     try:
         model_info = litellm.get_model_info(model=model)
-        input_cost_per_token = model_info.get(token_type, 0.0)
-        if input_cost_per_token > 0:
-            return total_tokens * input_cost_per_token
+        cost_per_token = model_info.get(token_type) or 0.0
+        return total_tokens * cost_per_token
     except Exception as e:
         print(f"\nDEBUG: An error occurred during cost calculation: {e}")
+    return 0.0
+
+
+def count_usage(response, model: str) -> dict:
+    """
+    Tokens and cost of a litellm response, prompt tokens are priced as input and completion tokens as output.
+    """
+    usage = response.get("usage") or {}
+    prompt_tokens = usage.get("prompt_tokens", 0) or 0
+    completion_tokens = usage.get("completion_tokens", 0) or 0
+    prompt_cost = count_cost(prompt_tokens, model=model, token_type="input_cost_per_token")
+    completion_cost = count_cost(completion_tokens, model=model, token_type="output_cost_per_token")
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": usage.get("total_tokens", 0) or prompt_tokens + completion_tokens,
+        "prompt_cost": prompt_cost,
+        "completion_cost": completion_cost,
+        "cost": prompt_cost + completion_cost,
+    }
+
+
+class UsageLedger:
+    """
+    Records tokens, cost, latency and cache hits of every LLM request of a run, one JSON line per request appended
+    to a ledger file, followed by a run summary line with the throughput (tokens/sec) and the cost per file.
+
+    Requests answered from the LLM response cache cost nothing, their cost is recorded as saved_cost and their tokens
+    as cached_tokens, so prompt/completion tokens, throughput and mean latency only cover the requests sent to the LLM.
+    """
+
+    def __init__(self, path: str = "usage-ledger.jsonl", model: str = "gpt-4o", run: str = None, **run_params):
+        self.path = path
+        self.model = model
+        self.run = run or datetime.now().strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}"
+        self.run_params = run_params
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.cache_hits = 0
+        self.files = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.saved_cost = 0.0
+        self.latency = 0.0
+
+    def record(self, response, latency: float, label: str = None) -> dict:
+        usage = count_usage(response, self.model)
+        cache_hit = bool(getattr(response, "_hidden_params", {}).get("cache_hit"))
+        entry = {"type": "request", "run": self.run, "label": label, "model": self.model, "time": datetime.now().isoformat(),
+                 "latency": round(latency, 3), "cache_hit": cache_hit, **usage}
+        if cache_hit:
+            entry["saved_cost"] = entry["cost"]
+            entry["cost"] = 0.0
+        self.requests += 1
+        if cache_hit:
+            self.cache_hits += 1
+            self.cached_tokens += usage["prompt_tokens"] + usage["completion_tokens"]
+            self.saved_cost += entry["saved_cost"]
+        else:
+            self.prompt_tokens += usage["prompt_tokens"]
+            self.completion_tokens += usage["completion_tokens"]
+            self.cost += entry["cost"]
+            self.latency += latency
+        append_records(self.path, [entry])
+        return entry
+
+    def count_file(self) -> None:
+        self.files += 1
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        total_tokens = self.prompt_tokens + self.completion_tokens
+        llm_requests = self.requests - self.cache_hits
+        return {
+            "type": "run", "run": self.run, "model": self.model, "time": datetime.now().isoformat(), **self.run_params,
+            "elapsed": round(elapsed, 3), "files": self.files, "requests": self.requests, "cache_hits": self.cache_hits,
+            "prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens, "total_tokens": total_tokens,
+            "cached_tokens": self.cached_tokens, "cost": self.cost, "saved_cost": self.saved_cost,
+            "mean_latency": round(self.latency / llm_requests, 3) if llm_requests else 0.0,
+            "tokens_per_sec": round(total_tokens / elapsed, 1) if elapsed else 0.0,
+            "completion_tokens_per_sec": round(self.completion_tokens / elapsed, 1) if elapsed else 0.0,
+            "cost_per_file": self.cost / self.files if self.files else 0.0,
+        }
+
+    def close(self) -> dict:
+        summary = self.summary()
+        append_records(self.path, [summary])
+        print(f"Usage: {summary['requests']} requests ({summary['cache_hits']} cache hits), {summary['total_tokens']:,} tokens "
+              f"({summary['cached_tokens']:,} more from cache), "
+              f"${summary['cost']:.4f} (${summary['saved_cost']:.4f} saved by cache), {summary['tokens_per_sec']:,} tokens/s, "
+              f"${summary['cost_per_file']:.4f}/file, mean latency {summary['mean_latency']}s, ledger: {self.path}")
+        return summary
+
+
+def record_usage(response, model: str, latency: float, ledger: Optional[UsageLedger] = None, label: str = None) -> None:
+    """
+    Prints the usage of a litellm response and records it in the ledger if given.
+    """
+    entry = ledger.record(response, latency, label) if ledger else count_usage(response, model)
+    print(f"  - Usage: {entry['completion_tokens']} completion tokens - cost: {entry['completion_cost']}, "
+          f"{entry['prompt_tokens']} prompt tokens - cost: {entry['prompt_cost']}, "
+          f"{entry['total_tokens']} total tokens - cost: {entry['cost']}, latency: {latency:.2f}s")
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    return litellm.token_counter(model=model, text=text)
+
+
+class TokenBudgetStats:
+    """
+    Tokens kept and dropped by pack_by_token_budget, accumulated over all packed prompts of a run.
+    A candidate packed with a shorter rendering (e.g. signatures instead of the whole file) counts the difference as dropped.
+    """
+
+    def __init__(self):
+        self.bundles = 0
+        self.candidates = 0
+        self.included = 0
+        self.shortened = 0
+        self.included_tokens = 0
+        self.dropped_tokens = 0
+
+    def __repr__(self):
+        return (f"{self.bundles} bundles: {self.included}/{self.candidates} candidates included ({self.shortened} shortened), "
+                f"{self.included_tokens:,} tokens included, {self.dropped_tokens:,} tokens dropped")
+
+
+def pack_by_token_budget(candidates: list[list[str]], budget: int, model: str = "gpt-4o", stats: TokenBudgetStats = None) -> list[str]:
+    """
+    Packs as many candidates as fit in a token budget.
+
+    Candidates are ranked, most relevant first, each one is a list of renderings from the shortest to the fullest,
+    e.g. [signatures, whole file]. The shortest rendering of every candidate is packed in rank order first, skipping
+    the ones that no longer fit, then the packed candidates are upgraded to fuller renderings in rank order while
+    the budget allows.
+
+    :param candidates: Renderings of each candidate, ranked.
+    :param budget: Maximum number of tokens of the packed renderings.
+    :param model: The model for token counting.
+    :param stats: Accumulates the included and dropped tokens.
+    :return: The chosen rendering of every packed candidate, in rank order.
+    """
+    tokens = [[count_tokens(text, model) for text in renderings] for renderings in candidates]
+    chosen = [None] * len(candidates)
+    used = 0
+    for i, candidate_tokens in enumerate(tokens):
+        if used + candidate_tokens[0] <= budget:
+            chosen[i] = 0
+            used += candidate_tokens[0]
+    for i, candidate_tokens in enumerate(tokens):
+        if chosen[i] is None:
+            continue
+        for level in range(len(candidate_tokens) - 1, chosen[i], -1):
+            extra = candidate_tokens[level] - candidate_tokens[chosen[i]]
+            if used + extra <= budget:
+                chosen[i] = level
+                used += extra
+                break
+
+    if stats is not None:
+        stats.bundles += 1
+        stats.candidates += len(candidates)
+        for level, candidate_tokens in zip(chosen, tokens):
+            if level is None:
+                stats.dropped_tokens += candidate_tokens[-1]
+                continue
+            stats.included += 1
+            stats.included_tokens += candidate_tokens[level]
+            if level < len(candidate_tokens) - 1:
+                stats.shortened += 1
+                stats.dropped_tokens += candidate_tokens[-1] - candidate_tokens[level]
+    return [renderings[level] for renderings, level in zip(candidates, chosen) if level is not None]
+
+
+def _count_file_tokens(file_paths: list[str], model: str) -> list[Optional[int]]:
+    counts = []
+    for file_path in file_paths:
+        try:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                counts.append(litellm.token_counter(model=model, text=f.read()))
+        except Exception as e:
+            print(f"❌ Failed to process file {file_path}: {e}")
+            counts.append(None)
+    return counts
+
+
+def _file_hash(file_path: str) -> Optional[str]:
+    try:
+        with open(file_path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError as e:
+        print(f"❌ Failed to read file {file_path}: {e}")
+        return None
+
+
+def _load_token_cache(cache_path: str, model: str) -> dict[str, int]:
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get(model, {})
+
+
+def _save_token_cache(cache_path: str, model: str, counts: dict[str, int]) -> None:
+    data = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    data[model] = counts
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, cache_path)
+
+
+def _print_breakdown(title: str, tokens: dict[str, int], files: dict[str, int], total_tokens: int, top: int) -> None:
+    print(f"{title}:")
+    ranked = sorted(tokens.items(), key=lambda item: item[1], reverse=True)
+    for key, count in ranked[:top]:
+        share = count / total_tokens * 100 if total_tokens else 0
+        print(f"  {key:<50} {count:>12,} tokens {share:>6.1f}% {files[key]:>7,} files")
+    if len(ranked) > top:
+        print(f"  ... {len(ranked) - top} more")
+
 
 def count_repo_tokens(
     repo_path: str,
-    model: str = "gpt-4o"
+    model: str = "gpt-4o",
+    workers: int = 1,
+    cache_path: str = "token-count-cache.json",
+    depth: int = 1,
+    top: int = 20
 ):
     """
     Calculates tokens and estimates input cost for a repository.
 
+    Token counts are cached by file content hash in cache_path, a repeated estimate only counts new or changed files.
+
     :param repo_path: Path to the local code repository.
     :param model: The model for token counting and cost estimation.
+    :param workers: Number of processes counting tokens, 1 counts in this process.
+    :param cache_path: JSON file of the token counts by model and content hash, empty to disable the cache.
+    :param depth: Number of leading directories of the relative path grouped in the per-directory breakdown.
+    :param top: Number of rows of each breakdown.
     """
     if not os.path.isdir(repo_path):
         print(f"❌ Error: The provided path '{repo_path}' is not a valid directory.")
@@ -51,16 +295,50 @@ def count_repo_tokens(
         print("\n⚠️ No processable code files found in the specified path (after exclusions).")
         return
 
+    cache = _load_token_cache(cache_path, model)
+    # unreadable files (permissions, broken symlinks, deleted during the run) are skipped
+    hashes = [_file_hash(file_path) for file_path in files_to_process]
+    unreadable = sum(content_hash is None for content_hash in hashes)
+    file_tokens = [cache.get(content_hash) if content_hash else None for content_hash in hashes]
+    misses = [i for i, tokens in enumerate(file_tokens) if tokens is None and hashes[i] is not None]
+    print(f"  - {len(files_to_process) - len(misses) - unreadable} of {len(files_to_process)} files counted from cache"
+          + (f", {unreadable} unreadable files skipped" if unreadable else ""))
+
+    with tqdm(total=len(misses), desc="Processing files", unit="file", ncols=100) as pbar:
+        if workers > 1 and len(misses) > 1:
+            chunk_size = max(1, min(64, len(misses) // (workers * 4)))
+            chunks = [misses[i:i + chunk_size] for i in range(0, len(misses), chunk_size)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(_count_file_tokens, [files_to_process[i] for i in chunk], model): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    for i, tokens in zip(futures[future], future.result()):
+                        file_tokens[i] = tokens
+                    pbar.update(len(futures[future]))
+        else:
+            for i in misses:
+                file_tokens[i] = _count_file_tokens([files_to_process[i]], model)[0]
+                pbar.update(1)
+
+    if cache_path:
+        for content_hash, tokens in zip(hashes, file_tokens):
+            if content_hash and tokens is not None:
+                cache[content_hash] = tokens
+        _save_token_cache(cache_path, model, cache)
+
     total_tokens = 0
-    with tqdm(total=len(files_to_process), desc="Processing files", unit="file", ncols=100) as pbar:
-        for file_path in files_to_process:
-            try:
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                    total_tokens += litellm.token_counter(model=model, text=content)
-            except Exception as e:
-                tqdm.write(f"❌ Failed to process file {file_path}: {e}")
-            pbar.update(1)
+    extension_tokens, extension_files = defaultdict(int), defaultdict(int)
+    directory_tokens, directory_files = defaultdict(int), defaultdict(int)
+    for file_path, tokens in zip(files_to_process, file_tokens):
+        if tokens is None:
+            continue
+        total_tokens += tokens
+        extension = os.path.splitext(file_path)[1] or os.path.basename(file_path)
+        extension_tokens[extension] += tokens
+        extension_files[extension] += 1
+        directory = os.path.dirname(os.path.relpath(file_path, abs_repo_path))
+        directory = os.path.join(*directory.split(os.sep)[:depth]) if directory else "."
+        directory_tokens[directory] += tokens
+        directory_files[directory] += 1
 
     estimated_cost = count_cost(total_tokens, model=model)
 
@@ -73,6 +351,8 @@ def count_repo_tokens(
     else:
         print(f"⚠️ Could not calculate cost for model '{model}'. It may not be in litellm's pricing data.")
     print("="*50)
+    _print_breakdown("By extension", extension_tokens, extension_files, total_tokens, top)
+    _print_breakdown(f"By directory (depth {depth})", directory_tokens, directory_files, total_tokens, top)
 
 def count_stdin_tokens(
     model: str = "gpt-4o"
@@ -1,10 +1,15 @@
 # @author: stephen
 
 import fire
-import json
+from collections import Counter
+from itertools import chain
+from typing import Iterable, Iterator
 from library.java_parser import JavaParser
 from library.repo_java_parser import RepoJavaParser
 from library.action_trace import ActionTraces, RecentActions
+from library.trace_store import TraceSnapshotStore
+from library.qa_dedup import NearDuplicateFilter
+from library.jsonl_utils import read_records, write_records, convert_json_array_to_jsonl
 
 
 def fetch_recent_traces(size: int = 10, path: str = None) -> None:
@@ -12,18 +17,19 @@ def fetch_recent_traces(size: int = 10, path: str = None) -> None:
     actions.print_recent_actions()
 
 
-def trace(action: str) -> str:
-    parser = ActionTraces(action)
+def trace(action: str, trace_store_path: str = "trace-snapshots.sqlite", trace_ttl_hours: float = 168) -> str:
+    store = TraceSnapshotStore(trace_store_path, trace_ttl_hours) if trace_store_path else None
+    parser = ActionTraces(action, store=store)
     return str(parser)
 
 
-def parse_file(file_path: str) -> str:
-    parser = JavaParser(file_path)
+def parse_file(file_path: str, engine: str = "cursor") -> str:
+    parser = JavaParser(file_path, engine=engine)
     return str(parser.result)
 
 
-def parse_repo(repo_path: str, reparse: bool = False, output_path: str = None) -> str:
-    parser = RepoJavaParser(repo_path, reparse, output_path)
+def parse_repo(repo_path: str, reparse: bool = False, output_path: str = None, workers: int = 1, incremental: bool = False, cache_format: str = "json") -> str:
+    parser = RepoJavaParser(repo_path, reparse, output_path, workers, incremental, cache_format)
     return "Parsed repository successfully: " + str(parser.output_path)
 
 
@@ -33,61 +39,88 @@ def find_reference(repo_path: str, package: str, class_name: str) -> list[str]:
     return [rst.path for rst in rsts]
 
 
-def merge_library_and_example_qa_result(library_qa_path: str = "library-source-code-to-qa.jsonl", example_qa_path: str = "example-repo-action-to-qa.jsonl", output_qa_path: str = "train.jsonl") -> None:
-    with open(library_qa_path, 'r', encoding='utf-8') as lib_file:
-        lib_qa = json.load(lib_file)
+def _counted(records: Iterable[dict], counts: Counter, name: str) -> Iterator[dict]:
+    for record in records:
+        counts[name] += 1
+        yield record
 
-    with open(example_qa_path, 'r', encoding='utf-8') as ex_file:
-        exm_qa = json.load(ex_file)
 
-    merged_qa = lib_qa + exm_qa
+def _qa_to_prompt_completion(records: Iterable[dict]) -> Iterator[dict]:
+    for qa in records:
+        yield {"prompt": qa['query'], "completion": qa['response']}
 
-    with open(output_qa_path, 'w', encoding='utf-8') as out_file:
-        for qa in merged_qa:
-            rst = {"prompt": qa['query'], "completion": qa['response']}
-            out_file.write(json.dumps(rst, ensure_ascii=False) + '\n')
 
-    print(f"Merged {len(lib_qa)} library QA entries and {len(exm_qa)} example QA entries into {output_qa_path}")
+def _chat_to_prompt_completion(records: Iterable[dict]) -> Iterator[dict]:
+    for data in records:
+        yield {"prompt": data['messages'][1]["content"], "completion": data['messages'][2]["content"]}
 
 
-def merge_wiki_to_jsonl(wiki_qa_path: str = "../train-wiki.jsonl", original_qa_path: str = "train.jsonl", output_qa_path: str = "../train-v2.jsonl") -> None:
-    merged_qa = []
-    wiki_count = 0
-    original_count = 0
+def _dedup_filter(dedup: bool, dedup_threshold: float, dedup_fields) -> NearDuplicateFilter | None:
+    if not dedup:
+        return None
+    fields = dedup_fields.split(",") if isinstance(dedup_fields, str) else dedup_fields
+    return NearDuplicateFilter(fields=fields, threshold=dedup_threshold)
 
-    with open(wiki_qa_path, 'r', encoding='utf-8') as wiki_fd:
-        for line in wiki_fd:
-            data = json.loads(line)
-            j = {"prompt": data['messages'][1]["content"], "completion": data['messages'][2]["content"]}
-            merged_qa.append(j)
-            wiki_count += 1
 
-    with open(original_qa_path, 'r', encoding='utf-8') as original_fd:
-        for line in original_fd:
-            merged_qa.append(json.loads(line))
-            original_count += 1
+def _deduplicated(records: Iterable[dict], dedup_filter: NearDuplicateFilter | None) -> Iterable[dict]:
+    return dedup_filter.filter(records) if dedup_filter else records
 
-    with open(output_qa_path, 'w', encoding='utf-8') as out_file:
-        for entry in merged_qa:
-            out_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
 
+def merge_library_and_example_qa_result(library_qa_path: str = "library-source-code-to-qa.jsonl", example_qa_path: str = "example-repo-action-to-qa.jsonl", output_qa_path: str = "train.jsonl",
+                                        dedup: bool = False, dedup_threshold: float = 0.8, dedup_fields: str = "prompt") -> None:
+    """
+    Merge library and example Q&A (JSON array or JSONL) into prompt/completion JSONL, streamed record by record.
 
-    print(f"Merged {wiki_count} wiki QA entries and {original_count} original QA entries into {output_qa_path}")
+    :param dedup: Drop pairs that are near duplicates of a pair merged before.
+    :param dedup_threshold: Estimated Jaccard similarity of word shingles from which pairs are duplicates.
+    :param dedup_fields: Comma separated fields compared for dedup, "prompt" and/or "completion".
+    """
+    counts = Counter()
+    dedup_filter = _dedup_filter(dedup, dedup_threshold, dedup_fields)
+    merged_qa = chain(_counted(read_records(library_qa_path), counts, "library"),
+                      _counted(read_records(example_qa_path), counts, "example"))
+    written = write_records(output_qa_path, _deduplicated(_qa_to_prompt_completion(merged_qa), dedup_filter))
+
+    print(f"Merged {counts['library']} library QA entries and {counts['example']} example QA entries into {output_qa_path}")
+    if dedup_filter:
+        print(f"Dedup: {dedup_filter}, {written} entries written")
+
+
+def merge_wiki_to_jsonl(wiki_qa_path: str = "../train-wiki.jsonl", original_qa_path: str = "train.jsonl", output_qa_path: str = "../train-v2.jsonl",
+                        dedup: bool = False, dedup_threshold: float = 0.8, dedup_fields: str = "prompt") -> None:
+    """
+    Merge wiki Q&A in chat completion format with prompt/completion Q&A into prompt/completion JSONL, streamed record by record.
+
+    :param dedup: Drop pairs that are near duplicates of a pair merged before, wiki pairs are kept over original ones.
+    :param dedup_threshold: Estimated Jaccard similarity of word shingles from which pairs are duplicates.
+    :param dedup_fields: Comma separated fields compared for dedup, "prompt" and/or "completion".
+    """
+    counts = Counter()
+    dedup_filter = _dedup_filter(dedup, dedup_threshold, dedup_fields)
+    merged_qa = chain(_chat_to_prompt_completion(_counted(read_records(wiki_qa_path), counts, "wiki")),
+                      _counted(read_records(original_qa_path), counts, "original"))
+    written = write_records(output_qa_path, _deduplicated(merged_qa, dedup_filter))
+
+    print(f"Merged {counts['wiki']} wiki QA entries and {counts['original']} original QA entries into {output_qa_path}")
+    if dedup_filter:
+        print(f"Dedup: {dedup_filter}, {written} entries written")
+
+
+def to_jsonl(input_path: str, output_path: str = None) -> None:
+    """
+    Convert a Q&A file written as one JSON array by older versions of repo2qa into JSONL, in place by default.
+    """
+    convert_json_array_to_jsonl(input_path, output_path)
 
 
 CORE_NG_CODING_SYSTEM_PROMPT = """You are a helpful coding assistant. Your task is to assist with coding-related questions and tasks. Please provide clear and concise answers, and if necessary, write code snippets in a format that is easy to understand and execute."""
 
 def change_text_generation_format_to_chat_completion_format(input_path: str, output_path: str, system_prompt: str = CORE_NG_CODING_SYSTEM_PROMPT) -> None:
-    data = []
-    with open(input_path, 'r', encoding='utf-8') as input_file:
-        lines = input_file.readlines()
-        for line in lines:
-            j = json.loads(line)
-            chat = {"messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": j["prompt"]}, {"role": "assistant", "content": j["completion"]}]}
-            data.append(chat)
-    with open(output_path, 'w', encoding='utf-8') as output_file:
-        for entry in data:
-            output_file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    def to_chat(records: Iterable[dict]) -> Iterator[dict]:
+        for j in records:
+            yield {"messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": j["prompt"]}, {"role": "assistant", "content": j["completion"]}]}
+
+    write_records(output_path, to_chat(read_records(input_path)))
 
 
 if __name__ == "__main__":
@@ -99,5 +132,6 @@ if __name__ == "__main__":
         "recent": fetch_recent_traces,
         "merge": merge_library_and_example_qa_result,
         "mergev2": merge_wiki_to_jsonl,
-        "change_format": change_text_generation_format_to_chat_completion_format
+        "change_format": change_text_generation_format_to_chat_completion_format,
+        "to_jsonl": to_jsonl
     })
\ No newline at end of file